@@ -1,78 +1,616 @@
 import utime
 import math
+import sys
+import binascii
+import select
+import micropython
 from array import array
-from machine import Pin, Timer
+from machine import Pin, Timer, idle
 from sound import Sound
 
-def read_words(filename):
-    buffer = bytearray(128)
-    with open(filename, 'rb', buffering=0) as file:
-        while True:
-            n = file.readinto(buffer)
-            if n == 0:
+# binary stream protocol: the host sends raw big-endian words in fixed-size chunks.
+# It may have STREAM_CHUNKS chunks in flight at once; each time the player has
+# played a whole chunk it writes STREAM_CREDIT back, allowing one more to be sent.
+# The stream ends with END_OF_STREAM, which also pads out the final chunk.
+# A chunk starting with ABORT_STREAM stops playback immediately; the host may
+# send one even when it has no credit left. If the buffer runs dry and nothing
+# arrives for STREAM_TIMEOUT_MS, the host is assumed to be gone.
+# When several boards play one song, the host puts SYNC_WORD into every board's
+# stream at the same points in the song; each board writes STREAM_SYNC back as it
+# plays one. The host answers any board that has drifted with a chunk starting
+# with NUDGE_WORD, which (like ABORT_STREAM) takes effect as soon as it arrives.
+# So that they start together, the boards are held: each takes its first chunks as
+# usual but only starts playing once a chunk starting with START_WORD arrives, which
+# the host sends every board at once after they all have their first chunks.
+STREAM_CHUNK = 128
+STREAM_CHUNKS = 8
+STREAM_CREDIT = b'\x01'
+STREAM_SYNC = b'\x02'
+STREAM_TIMEOUT_MS = 2000
+END_OF_STREAM = 0xFFFF
+ABORT_STREAM = 0xFFFE
+
+# sync: S = sequence number (informational; markers are reported in order)
+# 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+#  1  1  0  1  1  1  0  0 S7 S6 S5 S4 S3 S2 S1 S0
+SYNC_WORD = 0xDC00
+# nudge: N = milliseconds (signed) to move the rest of the song later by;
+# only valid as the first word of a chunk
+# 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+#  1  1  0  1  1  1  0  1 N7 N6 N5 N4 N3 N2 N1 N0
+NUDGE_WORD = 0xDD00
+# start: starts a held player; only valid as the first word of a chunk
+# 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+#  1  1  0  1  1  0  1  1  0  0  0  0  0  0  0  0
+START_WORD = 0xDB00
+# song boundary: the words after it belong to the next song of a playlist; it is
+# never sent or stored, but put in the ring by play_playlist() between songs
+# 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+#  1  1  0  1  1  1  1  0  0  0  0  0  0  0  0  0
+SONG_BOUNDARY = 0xDE00
+
+# while play_playlist() plays, the host may send it commands, one per line:
+#   queue PATH   play PATH after the songs already queued
+#   skip         move straight on to the next song
+#   stop         stop playing
+# It prints "playing PATH" as each song starts, "error PATH: ..." for one it
+# can't open, and "done" once the playlist is over.
+PLAYLIST_QUEUE = 'queue '
+PLAYLIST_SKIP = 'skip'
+PLAYLIST_STOP = 'stop'
+
+# songs on the filesystem are played through two FILE_CHUNK buffers, so the next
+# chunk is read while the current one plays
+FILE_CHUNK = 512
+FILE_CHUNKS = 2
+
+# fill buf from file, however many reads that takes, and return the number of
+# bytes read; it is only short of len(buf) at the end of the file
+def read_chunk(file, buf):
+    n = 0
+    size = len(buf)
+    while n < size:
+        # only slice (and allocate) after a short read
+        got = file.readinto(buf[n:] if n else buf)
+        if not got:
+            break
+        n += got
+    return n
+
+# fill chunk from file, and pad it out with END_OF_STREAM (over any odd byte left
+# at the end of the file) if the file runs out; returns False once it has
+def load_chunk(file, chunk):
+    n = read_chunk(file, chunk)
+    if n == len(chunk):
+        return True
+    for i in range(n & ~1, len(chunk)):
+        chunk[i] = END_OF_STREAM & 0xFF
+    return False
+
+# plays words out of a ring of fixed-size chunks, each at its deadline, from a
+# one-shot timer callback so the main loop is left free to keep the ring filled.
+# The main loop only ever advances `filled` and the callback only ever advances
+# `played`, so neither can corrupt the other's count when the callback interrupts.
+class PlaybackEngine:
+    def __init__(self, player, ring, chunk, jitter_log=None):
+        self.player = player
+        self.ring = ring
+        self.chunk = chunk
+        self.chunks = len(ring) // chunk
+        self.jitter_log = jitter_log
+        self.filled = 0       # chunks written by the main loop
+        self.played = 0       # chunks the engine has finished with
+        self.pos = 0          # byte offset of the next word in the ring
+        self.deadline = None  # when the next word is due, in ticks_us
+        self.starved = True   # stopped until the main loop supplies another chunk
+        self.held = False     # waiting for release() before it starts playing
+        self.synced = 0       # sync words played
+        self.songs = 0        # song boundaries played
+        self.nudged = 0       # milliseconds the main loop has asked the song to move by...
+        self.applied = 0      # ...and how many of them the engine has acted on
+        self.finished = False
+        self.timer = Timer()
+        # allocate the bound method once rather than every time the timer is armed
+        self._fire_cb = self._fire
+
+    # the slot the main loop may fill next, or -1 if the ring is full
+    def free_slot(self):
+        if self.filled - self.played >= self.chunks:
+            return -1
+        return self.filled % self.chunks
+
+    def chunk_filled(self):
+        self.filled += 1
+        self._resume()
+
+    # start an engine that is being held
+    def release(self):
+        self.held = False
+        self._resume()
+
+    def _resume(self):
+        if self.starved and not self.finished and not self.held and self.played != self.filled:
+            # no timer is armed while starved, so nothing else can be running the engine
+            self.starved = False
+            if self.deadline is None:
+                self.deadline = utime.ticks_us()
+            self._fire()
+
+    # move the rest of the song later (or earlier, if ms is negative); the engine
+    # picks this up the next time it waits, so the main loop never touches the deadline
+    def nudge(self, ms):
+        self.nudged += ms
+
+    def stop(self):
+        self.timer.deinit()
+        self.finished = True
+
+    # returns True once the deadline has arrived, or arms the timer and returns False.
+    # The timer only has millisecond resolution, so the last fraction is slept out.
+    def _wait(self):
+        nudged = self.nudged
+        if nudged != self.applied:
+            self.deadline = utime.ticks_add(self.deadline, (nudged - self.applied) * 1000)
+            self.applied = nudged
+        wait = utime.ticks_diff(self.deadline, utime.ticks_us())
+        if wait >= 1000:
+            self.timer.init(mode=Timer.ONE_SHOT, period=wait // 1000, callback=self._fire_cb)
+            return False
+        if wait > 0:
+            # sleep_us() busy-waits for short delays like this
+            utime.sleep_us(wait)
+        return True
+
+    # plays words until one is due later (arming the timer for it) or the ring runs
+    # dry. The read position is kept in a local and written back on the way out, and
+    # the end of the current chunk is tracked rather than found with a modulo per word.
+    def _fire(self, timer=None):
+        if not self._wait():
+            return
+        ring = self.ring
+        log = self.jitter_log
+        play_word = self.player.play_word
+        chunk = self.chunk
+        pos = self.pos
+        chunk_end = pos - pos % chunk + chunk
+        while not self.finished:
+            if self.played == self.filled:
+                self.starved = True
                 break
-            i = 0
-            while i + 1 < n:
-                yield (buffer[i] << 8) | buffer[i + 1]
-                i += 2
+            word = (ring[pos] << 8) | ring[pos + 1]
+            pos += 2
+            if pos == chunk_end:
+                if pos == len(ring):
+                    pos = 0
+                chunk_end = pos + chunk
+                self.played += 1
+            if word & 0x8000 == 0:
+                # note on, the commonest word by far
+                if log:
+                    log.record(self.deadline, utime.ticks_us())
+                play_word(word)
+            elif word == END_OF_STREAM:
+                self.finished = True
+            elif word & 0xc000 == 0x8000:
+                # delay: D = delay in milliseconds
+                # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+                #  1  0 DD DC DB DA D9 D8 D7 D6 D5 D4 D3 D2 D1 D0
+                # every deadline is the song's start time plus the sum of the encoded
+                # delays so far, so lateness in playing one word never carries over
+                self.deadline = utime.ticks_add(self.deadline, (word & 0x3FFF) * 1000)
+                if not self._wait():
+                    break
+            elif word & 0xff00 == SYNC_WORD:
+                self.synced += 1
+            elif word == SONG_BOUNDARY:
+                # the next song carries on from the last one's final deadline
+                self.songs += 1
+                self.player.end_song()
+            else:
+                if log:
+                    log.record(self.deadline, utime.ticks_us())
+                play_word(word)
+        self.pos = pos
+
+# records when each word was due and when it was actually played (in ticks_us),
+# in rings allocated up front so that recording never allocates during playback
+class JitterLog:
+    def __init__(self, size):
+        self.scheduled = array('i', [0] * size)
+        self.actual = array('i', [0] * size)
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def record(self, scheduled, actual):
+        i = self.count % len(self.scheduled)
+        self.scheduled[i] = scheduled
+        self.actual[i] = actual
+        self.count += 1
+
+    # (words recorded, p50, p99, max) lateness in microseconds, over the last `size` words
+    def stats(self):
+        n = min(self.count, len(self.scheduled))
+        if n == 0:
+            return None
+        late = sorted([utime.ticks_diff(self.actual[i], self.scheduled[i]) for i in range(n)])
+        return n, late[n // 2], late[n * 99 // 100], late[-1]
+
+    # print the raw rings for the host: the total count and ring size, then each
+    # ring as hex (little-endian int32), oldest entry at index count % size once it wraps
+    def dump(self):
+        print(self.count, len(self.scheduled))
+        print(binascii.hexlify(self.scheduled).decode())
+        print(binascii.hexlify(self.actual).decode())
+
+# a dense run of chords with no delays, for timing play_word()
+def benchmark_words(voices=4):
+    words = []
+    for freq in range(220, 880, 20):
+        for voice in range(voices):
+            words.append((voice << 11) | (freq + voice * 5))
+        words.append(0xC000 | ((1 << voices) - 1))
+    return words
 
 class MusicPlayer:
-    def __init__(self):
+    # songs for more than Sound.DRIVES drives need a player created with enough
+    # drives. tracks is the number of tracks on every drive, or a list with one per drive
+    def __init__(self, drives=Sound.DRIVES, tracks=80):
         # scanning is generally quieter than shaking; I use this method
         # on my 5.25" drive which would be too loud otherwise
-        self.sound = Sound(1 << 2)
+        self.sound = Sound(1 << 2, tracks=tracks, drives=drives)
+        self.jitter_log = None
+        self._reset_song()
+
+    # forget the last song's protocol revision and divider table (see play_word)
+    def _reset_song(self):
+        self._set_protocol(1)
+        self.dividers = None
+        self.dividers_pending = 0
+
+    # silence whatever the last song left playing and forget its settings
+    def end_song(self):
+        self.sound.silence()
+        self._reset_song()
+
+    # protocol 2 gives note-on words a 5-bit voice and a 10-bit frequency
+    def _set_protocol(self, revision):
+        if revision == 1:
+            self.voice_shift = 11
+            self.freq_mask = 0x7FF
+        elif revision == 2:
+            self.voice_shift = 10
+            self.freq_mask = 0x3FF
+        else:
+            raise ValueError('unsupported protocol revision {}'.format(revision))
+
+    # record how late each word is played, keeping the last `size` words
+    def instrument(self, size=1024):
+        self.jitter_log = JitterLog(size) if size else None
+
+    def jitter_stats(self):
+        return self.jitter_log.stats() if self.jitter_log else None
+
+    def dump_jitter(self):
+        if self.jitter_log:
+            self.jitter_log.dump()
+
+    # average microseconds play_word() takes over `words`, which must not include
+    # delays, counted across `repeat` runs
+    def benchmark(self, words=None, repeat=20):
+        if words is None:
+            words = benchmark_words()
+        try:
+            start = utime.ticks_us()
+            for _ in range(repeat):
+                for word in words:
+                    self.play_word(word)
+            elapsed = utime.ticks_diff(utime.ticks_us(), start)
+        finally:
+            self.sound.silence()
+        return elapsed / (repeat * len(words))
 
+    # plays a song file from FILE_CHUNKS reusable buffers, timing every word from the
+    # start of the song as PlaybackEngine does, but without a timer: nothing else needs
+    # the CPU, so the next chunk is read during the first delay of the current one and
+    # the rest of each delay is slept out
     def play_song(self, filename):
+        self._reset_song()
+        log = self.jitter_log
+        if log:
+            log.reset()
+        buffer = memoryview(bytearray(FILE_CHUNK * FILE_CHUNKS))
+        # slice the slots once, so that loading a chunk allocates nothing
+        slots = [buffer[i * FILE_CHUNK:(i + 1) * FILE_CHUNK] for i in range(FILE_CHUNKS)]
+        play_word = self.play_word
         try:
-            cmd_time = utime.ticks_ms()
-            for word in read_words(filename):
-                cmd_time = self.play_word(word, cmd_time)
+            with open(filename, 'rb', buffering=0) as file:
+                current = 0
+                chunk = slots[0]
+                more = load_chunk(file, chunk)
+                loaded = not more   # the next chunk has been read, or there isn't one
+                pos = 0
+                deadline = utime.ticks_us()
+                while True:
+                    if pos == FILE_CHUNK:
+                        current = (current + 1) % FILE_CHUNKS
+                        chunk = slots[current]
+                        if not loaded:
+                            more = load_chunk(file, chunk)
+                        loaded = not more
+                        pos = 0
+                    word = (chunk[pos] << 8) | chunk[pos + 1]
+                    pos += 2
+                    if word & 0x8000 == 0:
+                        if log:
+                            log.record(deadline, utime.ticks_us())
+                        play_word(word)
+                    elif word == END_OF_STREAM:
+                        break
+                    elif word & 0xc000 == 0x8000:
+                        deadline = utime.ticks_add(deadline, (word & 0x3FFF) * 1000)
+                        if not loaded:
+                            more = load_chunk(file, slots[(current + 1) % FILE_CHUNKS])
+                            loaded = True
+                        wait = utime.ticks_diff(deadline, utime.ticks_us())
+                        if wait > 0:
+                            utime.sleep_us(wait)
+                    else:
+                        if log:
+                            log.record(deadline, utime.ticks_us())
+                        play_word(word)
         finally:
             self.sound.silence()
 
-    def play_words(self, words, cmd_time):
+    # play each of files in turn, and any the host queues while they play (see
+    # PLAYLIST_QUEUE). Songs follow one another through a single engine, so the
+    # next song's first chunk is read while the last one's tail is still playing,
+    # and it starts on the last one's final deadline with no gap.
+    def play_playlist(self, files=()):
+        self.playlist = list(files)
+        self.command = bytearray()
+        if self.jitter_log:
+            self.jitter_log.reset()
+        poll = select.poll()
+        poll.register(sys.stdin, select.POLLIN)
         try:
-            for word in words:
-                cmd_time = self.play_word(word, cmd_time)
-            return cmd_time
-        except KeyboardInterrupt:
+            # a song queued after the last one had been read needs another engine
+            while self.playlist and self._play_queued(poll):
+                pass
+        finally:
             self.sound.silence()
-            raise
+        print('done')
 
-    def play_word(self, word, cmd_time):
-        if word & 0x8000 == 0:
-            # note on: V = voice; F = frequency
-            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
-            #  0 V3 V2 V1 V0 FA F9 F8 F7 F6 F5 F4 F3 F2 F1 F0
-            freq = word & 0x7FF
-            voice = (word & 0x7800) >> 11
-            self._note_on(voice, freq)
+    # plays the queued songs back to back until they run out or the host asks to
+    # skip (returning True, with the songs still to play back in the playlist) or
+    # to stop (returning False)
+    def _play_queued(self, poll):
+        self._reset_song()
+        engine = PlaybackEngine(self, bytearray(FILE_CHUNK * FILE_CHUNKS), FILE_CHUNK, self.jitter_log)
+        ring = memoryview(engine.ring)
+        slots = [ring[i * FILE_CHUNK:(i + 1) * FILE_CHUNK] for i in range(FILE_CHUNKS)]
+        loaded = []  # songs read into the ring, in order; engine.songs of them have finished
+        started = 0  # songs announced to the host
+        file = self._open_next(loaded)
+        if file is None:
+            return True
+        try:
+            while not engine.finished:
+                playing = engine.songs
+                while started <= playing and started < len(loaded):
+                    print('playing', loaded[started])
+                    started += 1
+                command = self._receive_command(poll)
+                if command == PLAYLIST_STOP:
+                    return False
+                if command == PLAYLIST_SKIP:
+                    # songs after this one that were already started on are read again
+                    self.playlist[:0] = loaded[playing + 1:]
+                    return True
+                slot = engine.free_slot()
+                if file is None or slot < 0:
+                    # timer callbacks run while we idle
+                    idle()
+                    continue
+                chunk = slots[slot]
+                n = 0
+                while file:
+                    n += read_chunk(file, chunk[n:] if n else chunk)
+                    if n == FILE_CHUNK:
+                        break
+                    # this song ends here; the next one (if any) follows on in the
+                    # same chunk, overwriting any odd byte left at the end of this one
+                    file.close()
+                    n &= ~1
+                    file = self._open_next(loaded)
+                    if file:
+                        chunk[n] = SONG_BOUNDARY >> 8
+                        chunk[n + 1] = SONG_BOUNDARY & 0xFF
+                        n += 2
+                if not file:
+                    for i in range(n, FILE_CHUNK):
+                        chunk[i] = END_OF_STREAM & 0xFF
+                engine.chunk_filled()
+            # any song short enough to have started and finished since we last looked
+            for path in loaded[started:]:
+                print('playing', path)
+            return True
+        finally:
+            engine.stop()
+            if file:
+                file.close()
+            self.sound.silence()
+
+    # opens the next song in the playlist that can be opened, adding it to loaded;
+    # None once the playlist is empty
+    def _open_next(self, loaded):
+        while self.playlist:
+            path = self.playlist.pop(0)
+            try:
+                file = open(path, 'rb', buffering=0)
+            except OSError as e:
+                print('error {}: {}'.format(path, e))
+                continue
+            loaded.append(path)
+            return file
+        return None
+
+    # takes whatever the host has sent without blocking, queueing any songs it
+    # names, and returns PLAYLIST_SKIP or PLAYLIST_STOP if it asked for either
+    def _receive_command(self, poll):
+        result = None
+        while poll.poll(0):
+            byte = sys.stdin.buffer.read(1)
+            if byte != b'\n':
+                self.command += byte
+                continue
+            command = self.command.decode().strip()
+            self.command = bytearray()
+            if command.startswith(PLAYLIST_QUEUE):
+                self.playlist.append(command[len(PLAYLIST_QUEUE):].strip())
+            elif command in (PLAYLIST_SKIP, PLAYLIST_STOP):
+                result = command
+                break
+        return result
+
+    # play a binary word stream sent by the host over USB serial (see above);
+    # if held, nothing plays until the host sends START_WORD
+    def play_stream(self, held=False):
+        self._reset_song()
+        if self.jitter_log:
+            self.jitter_log.reset()
+        engine = PlaybackEngine(self, bytearray(STREAM_CHUNK * STREAM_CHUNKS), STREAM_CHUNK, self.jitter_log)
+        engine.held = held
+        ring = memoryview(engine.ring)
+        # slice the slots once, so that receiving a chunk allocates nothing
+        slots = [ring[i * STREAM_CHUNK:(i + 1) * STREAM_CHUNK] for i in range(STREAM_CHUNKS)]
+        control = bytearray(STREAM_CHUNK)
+        stdin = sys.stdin.buffer
+        stdout = sys.stdout.buffer
+        poll = select.poll()
+        poll.register(sys.stdin, select.POLLIN)
+
+        # take every chunk that has started to arrive, each with a single read straight
+        # into its slot: the host writes whole chunks at once, so the rest of one is
+        # never far behind its first byte. Returns the number of chunks taken, or -1
+        # if the host asked us to stop
+        def receive():
+            count = 0
+            while poll.poll(0):
+                slot = engine.free_slot()
+                # if the buffer is full, this can only be an out-of-band abort, nudge or start
+                chunk = control if slot < 0 else slots[slot]
+                stdin.readinto(chunk)
+                count += 1
+                first = (chunk[0] << 8) | chunk[1]
+                if first == ABORT_STREAM:
+                    return -1
+                # the slot of a nudge or start is left free for the next chunk
+                if first & 0xff00 == NUDGE_WORD:
+                    engine.nudge((first & 0xFF) - ((first & 0x80) << 1))
+                elif first == START_WORD:
+                    engine.release()
+                elif slot >= 0:
+                    engine.chunk_filled()
+            return count
+
+        # the stream is binary, so Ctrl-C must not be treated as an interrupt
+        micropython.kbd_intr(-1)
+        try:
+            credited = 0
+            synced = 0
+            last_received = utime.ticks_ms()
+            while not engine.finished:
+                received = receive()
+                if received < 0:
+                    break
+                while synced < engine.synced:
+                    stdout.write(STREAM_SYNC)
+                    synced += 1
+                while credited < engine.played:
+                    stdout.write(STREAM_CREDIT)
+                    credited += 1
+                if received:
+                    last_received = utime.ticks_ms()
+                elif engine.starved and utime.ticks_diff(utime.ticks_ms(), last_received) > STREAM_TIMEOUT_MS:
+                    break
+                else:
+                    # timer callbacks run while we idle
+                    idle()
+        finally:
+            engine.stop()
+            micropython.kbd_intr(3)
+            self.sound.silence()
 
-        elif word & 0xc000 == 0x8000:
-            # delay: D = delay in milliseconds
+    # plays one word other than a delay: PlaybackEngine waits out delays itself,
+    # against the song's running deadline
+    @micropython.native
+    def play_word(self, word):
+        if self.dividers_pending:
+            self._load_divider(word)
+
+        elif word & 0x8000 == 0:
+            # note on: V = voice; F = frequency, or divider table index
             # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
-            #  1  0 DD DC DB DA D9 D8 D7 D6 D5 D4 D3 D2 D1 D0
-            ms = word & 0x3FFF
-            # TODO figure out why utime.sleep_ms() sometimes failed to wake up
-            # and then be a bit nicer to the Pico by avoiding this busy wait
-            cmd_time = utime.ticks_add(cmd_time, ms)
-            while utime.ticks_diff(cmd_time, utime.ticks_ms()) > 0:
-                pass
+            #  0 V3 V2 V1 V0 FA F9 F8 F7 F6 F5 F4 F3 F2 F1 F0   (protocol 1)
+            #  0 V4 V3 V2 V1 V0 F9 F8 F7 F6 F5 F4 F3 F2 F1 F0   (protocol 2)
+            freq = word & self.freq_mask
+            voice = word >> self.voice_shift
+            self._note_on(voice, freq)
 
-        else:
-            # notes off: C = channel; V = voice mask
+        elif word & 0xf000 == 0xc000:
+            # notes off: V = voice mask, for voices 0-11
             # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
             #  1  1  0  0 VB VA V9 V8 V7 V6 V5 V4 V3 V2 V1 V0
             mask = word & 0xFFF
-            self._notes_off(mask)
+            self._notes_off(mask, 0)
 
-        return cmd_time
+        elif word & 0xf800 == 0xd000:
+            # divider table: N = number of entries, each of which follows as two
+            # words holding the high and low 12 bits of a clock divider
+            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+            #  1  1  0  1  0 NA N9 N8 N7 N6 N5 N4 N3 N2 N1 N0
+            self.dividers = []
+            self.dividers_pending = (word & 0x7FF) * 2
 
+        elif word & 0xff00 == 0xdf00:
+            # protocol revision: R = revision, for the rest of the song
+            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+            #  1  1  0  1  1  1  1  1 R7 R6 R5 R4 R3 R2 R1 R0
+            self._set_protocol(word & 0xFF)
+
+        elif word & 0xe000 == 0xe000:
+            # bank notes off: B = bank; V = mask of voices 12 + 10 * B onwards
+            # (bank 3 is reserved, for END_OF_STREAM and ABORT_STREAM)
+            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+            #  1  1  1  0 B1 B0 V9 V8 V7 V6 V5 V4 V3 V2 V1 V0
+            bank = (word >> 10) & 3
+            if bank != 3:
+                self._notes_off(word & 0x3FF, 12 + bank * 10)
+
+    # the dividers are stored ready to write to CLKDIV, so that playing
+    # a note from the table takes no arithmetic at all
+    def _load_divider(self, word):
+        if self.dividers_pending & 1:
+            self.dividers[-1] = (self.dividers[-1] | word) << 8
+        else:
+            self.dividers.append(word << 12)
+        self.dividers_pending -= 1
+
+    @micropython.native
     def _note_on(self, voice, freq):
-        self.sound.play(voice, freq)
+        if self.dividers is not None:
+            self.sound.play_divider(voice, self.dividers[freq])
+        else:
+            self.sound.play(voice, freq)
 
-    def _notes_off(self, mask):
-        for voice in range(12):
-            if 0 != (mask & (1 << voice)):
+    # mask bit 0 is voice first_voice, bit 1 the voice after that, and so on
+    @micropython.native
+    def _notes_off(self, mask, first_voice):
+        voice = first_voice
+        while mask:
+            if mask & 1:
                 self.sound.stop(voice)
-
+            mask >>= 1
+            voice += 1
@@ -2,51 +2,136 @@
 
 from rp2 import PIO, asm_pio, StateMachine
 from machine import Pin, freq, mem32
+import micropython
 import utime
 
+# the RP2040 has two PIO blocks and the RP2350 three, each with four state machines
+_PIO_BASES = (0x50200000, 0x50300000, 0x50400000)
+_SMS_PER_PIO = 4
+
+# the CLKDIV register of each state machine
+_SM_CLKDIV = tuple(base + offset
+                   for base in _PIO_BASES
+                   for offset in (0x0c8, 0x0e0, 0x0f8, 0x110))
+
+# how many state machines this chip has
+def state_machine_count():
+    for blocks in range(len(_PIO_BASES)):
+        try:
+            PIO(blocks)
+        except ValueError:
+            return blocks * _SMS_PER_PIO
+    return len(_PIO_BASES) * _SMS_PER_PIO
+
+# the CLKDIV value that runs a state machine at f Hz from a system clock of
+# sysclk Hz, or 0 if it can't run that fast or that slowly;
+# util/convert_midi.py does the same sums for --divider-table
+def _clock_divider(sysclk, f):
+    if f == 0:
+        return 0
+    div = (sysclk * 256) // f
+    if div < 0x100 or div >= 0x1000000:
+        return 0
+    return div << 8
+
 # there's no built-in way to do this, so HAX
-# also note that the upper limit on the original Pico is 8
-# and since I have an original Pico and only 4 drives, I
-# haven't tested any more than this!
 def _update_sm_freq(sm, f):
     if f == 0:
         return False
-    if sm < 0 or sm >= 12:
+    if sm < 0 or sm >= len(_SM_CLKDIV):
         raise ValueError("state machine index out of range")
-    base = [0x50200000, 0x50300000, 0x50400000][sm >> 2]
-    offset = [0x0c8, 0x0e0, 0x0f8, 0x110][sm & 3]
-    div = (freq() * 256) // f
-    if div < 0x100 or div >= 0x1000000:
+    div = _clock_divider(freq(), f)
+    if div == 0:
         return False
-    mem32[base + offset] = div << 8
+    mem32[_SM_CLKDIV[sm]] = div
     return True
 
-def _reset_drives(count, scan_mask, tracks):
-    ds = [Pin(i * 3, Pin.OUT, value=0) for i in range(count)]
-    dp = [Pin(i * 3 + 1, Pin.OUT, value=1) for i in range(count)]
-    step = [Pin(i * 3 + 2, Pin.OUT, value=1) for i in range(count)]
-    for _ in range(tracks):
-        for pin in step:
-            pin.value(0)
-        utime.sleep_ms(5)
-        for pin in step:
-            pin.value(1)
-        utime.sleep_ms(5)
-    for pin in dp:
-        pin.value(0)
-    utime.sleep_ms(50)
-    for _ in range(tracks//2):
-        for i in range(count):
-            if scan_mask & (1 << i) == 0:
-                step[i].value(0)
-        utime.sleep_ms(5)
-        for i in range(count):
-            if scan_mask & (1 << i) == 0:
-                step[i].value(1)
-        utime.sleep_ms(5)
-    for pin in ds:
-        pin.value(1)
-    utime.sleep_ms(50)
+# homing steps every drive at once from a PIO state machine, which sets all of a
+# group's pins together: up to 10 drives (30 consecutive GPIOs) per state machine,
+# the first state machine of each PIO block taking the next group
+_HOME_GROUP = 10
+# drives that were left shaking in the middle of the disk by an earlier Sound,
+# and how many tracks they have; they don't need homing again
+_parked = {}
+_home_progs = {}
+
+# the homing program for a group of `count` drives. Each run takes the pin levels
+# with the step pins low, then with them high, then the number of steps less one,
+# and reports back once it is done; 30 cycles a step, like the programs below
+def _home_prog(count):
+    prog = _home_progs.get(count)
+    if prog is None:
+        @asm_pio(out_init=(PIO.OUT_HIGH,) * (count * 3))
+        def prog():
+            pull()
+            mov(x, osr)
+            pull()
+            mov(isr, osr)
+            pull()
+            mov(y, osr)
+            label("step")
+            mov(pins, x)[14]
+            mov(pins, isr)[13]
+            jmp(y_dec, "step")
+            push()
+        _home_progs[count] = prog
+    return prog
+
+# GPIO levels for drives first..first+count-1 while homing: those in `selected`
+# selected and moving in `direction`, with those in `stepping` stepping if step is 0
+def _home_levels(first, count, selected, direction, stepping, step):
+    levels = 0
+    for i in range(count):
+        drive = first + i
+        if drive in selected:
+            bits = direction << 1 | (step if drive in stepping else 1) << 2
+        else:
+            bits = 0b111
+        levels |= bits << (i * 3)
+    return levels
+
+# step each of `drives` out past track 0 (tracks[drive] steps), then move those
+# in `centre` back to the middle of the disk, all together at step_hz steps a
+# second; returns how long it took in milliseconds
+def _home(drives, tracks, centre, step_hz):
+    if not drives:
+        return 0
+    start = utime.ticks_ms()
+    selected = set(drives)
+    settle = max(1, step_hz // 20)     # 50 ms
+    # (drives selected, drives stepping, direction, steps); drives drop out as they finish
+    segments = []
+    for direction, counts in ((1, {d: tracks[d] for d in drives}),
+                              (0, {d: tracks[d] // 2 for d in drives if d in centre})):
+        if direction == 0 and counts:
+            # let the heads settle after changing direction
+            segments.append((selected, (), 0, settle))
+        done = 0
+        for count in sorted(set(counts.values())):
+            if count > done:
+                segments.append((selected, [d for d in counts if counts[d] >= count], direction, count - done))
+                done = count
+    segments.append(((), (), 1, settle))
+    total = max(drives) + 1
+    groups = []
+    for first in range(0, total, _HOME_GROUP):
+        count = min(_HOME_GROUP, total - first)
+        prog = _home_prog(count)
+        sm = StateMachine(first // _HOME_GROUP * _SMS_PER_PIO, prog, freq=step_hz * 30, out_base=first * 3)
+        sm.active(1)
+        groups.append((first, count, prog, sm))
+    for selected, stepping, direction, steps in segments:
+        for first, count, _, sm in groups:
+            sm.put(_home_levels(first, count, selected, direction, stepping, 0))
+            sm.put(_home_levels(first, count, selected, direction, stepping, 1))
+            sm.put(steps - 1)
+        utime.sleep_ms(steps * 1000 // step_hz)
+        for group in groups:
+            group[3].get()
+    for first, _, prog, sm in groups:
+        sm.active(0)
+        PIO(first // _HOME_GROUP).remove_program(prog)
+    return utime.ticks_diff(utime.ticks_ms(), start)
 
 # scan back and forth across the disk
 @asm_pio(out_init=(PIO.OUT_HIGH), set_init=(PIO.OUT_HIGH))
@@ -79,16 +164,42 @@ def _shake_prog():
 # GPIO 1 = drive 0 direction
 # GPIO 2 = drive 0 step
 # GPIO 3 = drive 1 select ...
+# Drive n uses state machine n, so drives 0-3 run on PIO block 0, 4-7 on
+# block 1 and (on an RP2350) 8-11 on block 2. MicroPython loads each program
+# into a block only once, however many of its state machines run it.
 class Sound:
     DRIVES = 4
+    # how fast drives are stepped while homing; most manage 3 ms a step
+    HOME_STEP_HZ = 300
 
     # scan_mask indicates which drives scan across the whole disk
-    # instead of just shaking the head back and forth on one track
-    def __init__(self, scan_mask = 0, tracks = 80):
+    # instead of just shaking the head back and forth on one track.
+    # tracks is the number of tracks on every drive, or a list with one per drive.
+    # Drives are homed unless an earlier Sound left them shaking in the middle of
+    # the disk (scanning drives could be anywhere, so they are always homed);
+    # pass home=True to home every drive regardless. homing_ms says how long it took.
+    def __init__(self, scan_mask = 0, tracks = 80, drives = DRIVES, home = False):
+        available = state_machine_count()
+        if drives > available:
+            raise ValueError("this chip only has {} state machines".format(available))
+        if isinstance(tracks, int):
+            tracks = [tracks] * drives
+        elif len(tracks) < drives:
+            raise ValueError("tracks given for only {} drives".format(len(tracks)))
+        self.drives = drives
+        self.tracks = tracks
         self.drive_select_pins = []
         self.state_machines = []        
-        _reset_drives(Sound.DRIVES, scan_mask, tracks)
-        for drive in range(Sound.DRIVES):
+        shaking = [d for d in range(drives) if scan_mask & (1 << d) == 0]
+        unhomed = [d for d in range(drives)
+                   if home or d not in shaking or _parked.get(d) != tracks[d]]
+        self.homing_ms = _home(unhomed, tracks, shaking, self.HOME_STEP_HZ)
+        for drive in range(drives):
+            if drive in shaking:
+                _parked[drive] = tracks[drive]
+            else:
+                _parked.pop(drive, None)
+        for drive in range(drives):
             base_pin = drive * 3
             scan = scan_mask & (1 << drive) != 0
             self.drive_select_pins.append(Pin(base_pin, Pin.OUT, value=1))
@@ -98,12 +209,14 @@ class Sound:
                              freq=2000,
                              out_base=base_pin+1,
                              set_base=base_pin+2))
-            self.state_machines[drive].put(tracks - 1);
+            self.state_machines[drive].put(tracks[drive] - 1);
             
+    @micropython.native
     def stop(self, drive):
         self.state_machines[drive].active(0)
         self.drive_select_pins[drive].value(1)
 
+    @micropython.native
     def play(self, drive, freq):
         if _update_sm_freq(drive, freq * 30):
             self.drive_select_pins[drive].value(0)
@@ -111,8 +224,15 @@ class Sound:
         else:
             self.stop(drive)
                                        
+    # play a note whose CLKDIV value was worked out in advance (see _clock_divider)
+    @micropython.native
+    def play_divider(self, drive, div):
+        mem32[_SM_CLKDIV[drive]] = div
+        self.drive_select_pins[drive].value(0)
+        self.state_machines[drive].active(1)
+
     def silence(self):
-        for drive in range(Sound.DRIVES):
+        for drive in range(self.drives):
             self.stop(drive)
 
     def scale(self, drive, octave = 1):
@@ -0,0 +1,33 @@
+# The tests run the host tools in util/ against util/fake_pico.py, which runs the real
+# firmware on the stand-ins in util/stubs, so no Pico is needed. The tools import each
+# other as top-level modules, as they do when run from util/.
+import ast
+import os
+import shlex
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UTIL_DIR = os.path.join(ROOT, 'util')
+sys.path.insert(0, UTIL_DIR)
+
+# makes the player keep every word it plays; delays, sync words and the end of the
+# stream are handled by PlaybackEngine itself, so they never reach play_word()
+RECORD_WORDS = "m.played = []\r\nm.play_word = lambda w, play=m.play_word: (m.played.append(w), play(w))\r\n"
+
+# a device for PicoConnection that runs a fake Pico as a child process, with the
+# given fake_pico.py options
+def fake_pico_device(*options):
+    command = [sys.executable, os.path.join(UTIL_DIR, 'fake_pico.py'), '--stdio'] + list(options)
+    return 'exec:' + ' '.join(shlex.quote(arg) for arg in command)
+
+# sets up a player on the connection's fake Pico that records the words it plays
+def record_words(connection, drives):
+    connection.open_session(drives)
+    connection.pyboard.exec(RECORD_WORDS)
+
+def played_words(connection):
+    return ast.literal_eval(connection.pyboard.exec('print(m.played)\r\n').decode())
+
+# the words of a stream that the player hands to play_word()
+def playable(words):
+    return [w for w in words if w & 0xc000 != 0x8000 and w & 0xff00 != 0xdc00 and w != 0xFFFF]
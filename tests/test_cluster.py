@@ -0,0 +1,41 @@
+from conftest import fake_pico_device, played_words, playable, record_words
+import pico_cluster
+from pico_cluster import PicoCluster, split_stream
+
+# protocol 1 words
+def note_on(voice, freq):
+    return (voice << 11) | freq
+
+def delay(ms):
+    return 0x8000 | ms
+
+# five seconds of a note every 2 ms for voice 0, with voice 1 only playing at the
+# start and after four seconds
+def dense_and_sparse():
+    words = [note_on(1, 110)]
+    for i in range(2500):
+        if i == 2000:
+            words.append(note_on(1, 220))
+        words += [note_on(0, 200 + i % 200), delay(2)]
+    return words + [0xC003]
+
+# the board playing voice 1 has nothing to be sent for seconds at a time, far longer
+# than the player waits for the host before giving up, and must still play its part,
+# starting with the other board even though its first chunk is nowhere near full
+def test_sparse_board(monkeypatch):
+    # the splitter runs ahead of the dense board by this many words, so the sparse board
+    # gets nothing new for seconds at a time (as with the default, in a longer song)
+    monkeypatch.setattr(pico_cluster, 'QUEUE_WORDS', 1024)
+    words = dense_and_sparse()
+    cluster = PicoCluster([fake_pico_device(), fake_pico_device()])
+    try:
+        for connection in cluster.connections:
+            record_words(connection, 1)
+        assert cluster.play_song(iter(words), [1, 1])
+        # the fake Picos keep time far less steadily than real ones
+        assert cluster.worst_skew_ms < 50
+        for board, connection in enumerate(cluster.connections):
+            expected = [w for b, w in split_stream(words, [1, 1]) if b == board]
+            assert played_words(connection) == playable(expected)
+    finally:
+        cluster.close()
@@ -0,0 +1,132 @@
+import sys
+import threading
+import time
+from conftest import RECORD_WORDS, fake_pico_device, played_words, playable, record_words
+import convert_midi
+from convert_midi import Encoder, encode_file
+from pico_connection import PicoConnection
+
+# protocol 1 words
+def note_on(voice, freq):
+    return (voice << 11) | freq
+
+def delay(ms):
+    return 0x8000 | ms
+
+# a note every 10 ms on two voices, then both of them off
+def scale(notes):
+    words = []
+    for i in range(notes):
+        words += [note_on(i % 2, 200 + i % 400), delay(10)]
+    return words + [0xC003]
+
+def varlen(value):
+    data = bytearray([value & 0x7F])
+    while value > 0x7F:
+        value >>= 7
+        data.insert(0, 0x80 | (value & 0x7F))
+    return bytes(data)
+
+# a type 0 MIDI file at the default tempo, with 480 ticks a beat (about a millisecond
+# a tick), of (start tick, length in ticks, 1-based channel, note)
+def write_midi(path, notes):
+    events = []
+    for start, length, channel, note in notes:
+        events.append((start, bytes([0x90 | (channel - 1), note, 64])))
+        events.append((start + length, bytes([0x80 | (channel - 1), note, 0])))
+    track = bytearray()
+    tick = 0
+    for at, message in sorted(events, key=lambda e: e[0]):
+        track += varlen(at - tick) + message
+        tick = at
+    track += b'\x00\xff\x2f\x00'
+    with open(path, 'wb') as f:
+        f.write(b'MThd' + (6).to_bytes(4, 'big') + (0).to_bytes(2, 'big') + (1).to_bytes(2, 'big')
+                + (480).to_bytes(2, 'big'))
+        f.write(b'MTrk' + len(track).to_bytes(4, 'big') + track)
+
+# every word play_song() sends for a song, including the fade at the end
+def streamed(words):
+    return list(words) + [delay(1000)]
+
+# convert_midi.py plays each song given with --then straight after the first, in the
+# same session, without setting up a new player
+def test_then(tmp_path, monkeypatch):
+    first, second = tmp_path / 'first.mid', tmp_path / 'second.mid'
+    write_midi(first, [(i * 60, 50, 1 + i % 2, 60 + i) for i in range(8)])
+    write_midi(second, [(i * 40, 120, 2, 72 - i) for i in range(6)] + [(0, 240, 1, 48)])
+    expected = []
+    for song in (first, second):
+        expected += playable(streamed(encode_file(str(song), Encoder([[1], [2]]))))
+    sessions = []
+    played = []
+
+    # records the words the player is given, and collects them before the session closes
+    class RecordingConnection(PicoConnection):
+        def open_session(self, drives=4, fresh=False):
+            timings = super().open_session(drives, fresh)
+            self.pyboard.exec(RECORD_WORDS)
+            sessions.append(timings)
+            return timings
+
+        def close(self):
+            played.extend(played_words(self))
+            super().close()
+
+    monkeypatch.setattr(convert_midi, 'PicoConnection', RecordingConnection)
+    monkeypatch.setattr(sys, 'argv', ['convert_midi.py', str(first), '-', '1', '2', '--then', str(second),
+                                      '--device', fake_pico_device('--virtual-clock'), '--no-cache'])
+    convert_midi.main()
+    assert len(sessions) == 1
+    assert played == expected
+
+# Ctrl+C while the words are still being produced stops the song part of the way
+# through, and leaves the player ready for the next one
+def test_interrupted_song():
+    words = scale(500)
+
+    # half a second into the song, with nothing more ready
+    def interrupted():
+        yield from words[:300]
+        until = time.monotonic() + 0.5
+        while time.monotonic() < until:
+            yield None
+            time.sleep(0.01)
+        raise KeyboardInterrupt
+
+    connection = PicoConnection(fake_pico_device())
+    try:
+        record_words(connection, 2)
+        assert not connection.play_song(interrupted())
+        played = played_words(connection)
+        assert 0 < len(played) < len(playable(words[:300]))
+        assert played == playable(words)[:len(played)]
+        connection.pyboard.exec('m.played = []\r\n')
+        short = scale(20)
+        assert connection.play_song(iter(short))
+        assert played_words(connection) == playable(streamed(short))
+    finally:
+        connection.close()
+
+# abort() from another thread, once every word has been sent, stops the song before
+# the player has played out what it was sent
+def test_abort_while_draining():
+    words = scale(300)
+    connection = PicoConnection(fake_pico_device())
+
+    def abort_once_draining():
+        while not connection.draining:
+            time.sleep(0.01)
+        connection.abort()
+
+    try:
+        record_words(connection, 2)
+        aborter = threading.Thread(target=abort_once_draining)
+        aborter.start()
+        connection.play_song(iter(words))
+        aborter.join()
+        played = played_words(connection)
+        assert len(played) < len(playable(words))
+        assert played == playable(words)[:len(played)]
+    finally:
+        connection.close()
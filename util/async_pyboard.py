@@ -0,0 +1,171 @@
+# An asyncio counterpart to the parts of pyboard.Pyboard the host tools use.
+# Pyboard polls inWaiting() and sleeps 10 ms between polls; this registers the
+# connection with the event loop instead and wakes as soon as the board sends
+# anything, so REPL round trips don't wait on a poll, and one thread can talk to
+# several boards at once. Any device Pyboard can open works: a serial port, an
+# exec:/execpty: process (such as util/fake_pico.py) or a telnet address.
+import asyncio
+import os
+from pyboard import Pyboard, PyboardError, TelnetToSerial
+
+RAW_REPL_PROMPT = b'raw REPL; CTRL-B to exit\r\n'
+
+# returns (file descriptor to watch, function reading whatever is available)
+# for one of Pyboard's connections; the function raises EOFError once the other
+# end has gone away
+def _reader(connection):
+    if isinstance(connection, TelnetToSerial):
+        # telnetlib has to see the data to handle option negotiation
+        return connection.tn.fileno(), connection.tn.read_eager
+    fd = connection.fileno()
+    def read():
+        data = os.read(fd, 4096)
+        if not data:
+            raise EOFError
+        return data
+    return fd, read
+
+class AsyncPyboard:
+    # use connect() rather than creating one directly
+    def __init__(self, device, baudrate=115200, user='micro', password='python'):
+        # Pyboard opens the connection (and logs in over telnet); we take over from there
+        self.pyboard = Pyboard(device, baudrate, user, password)
+        self.serial = self.pyboard.serial.serial
+        self.fd, self._read_available = _reader(self.serial)
+        self.buffer = bytearray(getattr(self.serial, 'fifo', b''))
+        self.received = asyncio.Event()
+        self.closed = False
+        self.use_raw_paste = True
+
+    @classmethod
+    async def connect(cls, device, **kwargs):
+        board = cls(device, **kwargs)
+        asyncio.get_running_loop().add_reader(board.fd, board._on_readable)
+        return board
+
+    def close(self):
+        if not self.closed:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            self.closed = True
+        self.pyboard.close()
+
+    def write(self, data):
+        self.serial.write(data)
+
+    # how many bytes have been received but not read yet
+    def in_waiting(self):
+        return len(self.buffer)
+
+    # up to size bytes that have already been received, without waiting
+    def read_waiting(self, size=None):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:len(data)]
+        return data
+
+    async def read(self, size=1, timeout=10):
+        await self._wait_for(lambda: size if len(self.buffer) >= size else -1, timeout)
+        return self.read_waiting(size)
+
+    # everything up to and including ending; raises PyboardError if it doesn't
+    # arrive within timeout seconds (None waits for ever)
+    async def read_until(self, ending, timeout=10):
+        def end():
+            i = self.buffer.find(ending)
+            return i + len(ending) if i >= 0 else -1
+        return self.read_waiting(await self._wait_for(end, timeout))
+
+    async def enter_raw_repl(self, soft_reset=True):
+        self.write(b'\r\x03\x03')  # ctrl-C twice: interrupt any running program
+        self.read_waiting()
+        self.write(b'\r\x01')  # ctrl-A: enter raw REPL
+        if soft_reset:
+            await self.read_until(RAW_REPL_PROMPT + b'>')
+            self.write(b'\x04')  # ctrl-D: soft reset
+            await self.read_until(b'soft reboot\r\n')
+        await self.read_until(RAW_REPL_PROMPT)
+
+    def exit_raw_repl(self):
+        self.write(b'\r\x02')  # ctrl-B: enter friendly REPL
+
+    # returns (output, error output) of the command being run
+    async def follow(self, timeout=10):
+        data = await self.read_until(b'\x04', timeout)
+        data_err = await self.read_until(b'\x04', timeout)
+        return data[:-1], data_err[:-1]
+
+    async def exec_raw_no_follow(self, command):
+        command_bytes = command if isinstance(command, bytes) else command.encode()
+        await self.read_until(b'>')
+        if self.use_raw_paste:
+            self.write(b'\x05A\x01')
+            data = await self.read(2)
+            if data == b'R\x01':
+                return await self._raw_paste_write(command_bytes)
+            if data != b'R\x00':
+                # doesn't understand raw-paste mode at all
+                await self.read_until(b'w REPL; CTRL-B to exit\r\n>')
+            self.use_raw_paste = False
+        for i in range(0, len(command_bytes), 256):
+            self.write(command_bytes[i:i + 256])
+            await asyncio.sleep(0.01)
+        self.write(b'\x04')
+        data = await self.read(2)
+        if data != b'OK':
+            raise PyboardError('could not exec command (response: {!r})'.format(data))
+
+    async def exec_raw(self, command, timeout=10):
+        await self.exec_raw_no_follow(command)
+        return await self.follow(timeout)
+
+    async def exec_(self, command):
+        ret, ret_err = await self.exec_raw(command)
+        if ret_err:
+            raise PyboardError('exception', ret, ret_err)
+        return ret
+
+    async def _raw_paste_write(self, command_bytes):
+        data = await self.read(2)
+        window_size = data[0] | data[1] << 8
+        window_remain = window_size
+        i = 0
+        while i < len(command_bytes):
+            while window_remain == 0 or self.buffer:
+                data = await self.read(1)
+                if data == b'\x01':
+                    window_remain += window_size
+                elif data == b'\x04':
+                    # the board has stopped reading; acknowledge it
+                    self.write(b'\x04')
+                    return
+                else:
+                    raise PyboardError('unexpected read during raw paste: {!r}'.format(data))
+            b = command_bytes[i:i + window_remain]
+            self.write(b)
+            window_remain -= len(b)
+            i += len(b)
+        self.write(b'\x04')
+        await self.read_until(b'\x04')
+
+    # waits until found() returns how many buffered bytes to read, rather than -1
+    async def _wait_for(self, found, timeout):
+        async def wait():
+            while True:
+                n = found()
+                if n >= 0:
+                    return n
+                if self.closed:
+                    raise PyboardError('connection closed')
+                self.received.clear()
+                await self.received.wait()
+        try:
+            return await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            raise PyboardError('timed out waiting for the board: {!r}'.format(bytes(self.buffer)))
+
+    def _on_readable(self):
+        try:
+            self.buffer += self._read_available()
+        except (OSError, EOFError):
+            asyncio.get_running_loop().remove_reader(self.fd)
+            self.closed = True
+        self.received.set()
@@ -0,0 +1,297 @@
+# Host-side benchmarks of the firmware, run against the MicroPython stand-ins in
+# util/stubs on a virtual clock, and of the conversion tools. Timings are for
+# CPython on this computer rather than a Pico, so compare them with each other only.
+#   python3 util/benchmark.py reader song.dat
+#   python3 util/benchmark.py dispatch
+#   python3 util/benchmark.py repl
+#   python3 util/benchmark.py encoder --save baseline.json
+from argparse import ArgumentParser
+import io
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from mido import Message, MetaMessage, MidiFile, MidiTrack
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE_DIR = os.path.join(os.path.dirname(UTIL_DIR), 'firmware')
+sys.path[:0] = [os.path.join(UTIL_DIR, 'stubs'), FIRMWARE_DIR]
+
+import utime
+from music_player import MusicPlayer, benchmark_words
+from pyboard import Pyboard
+from convert_midi import Encoder, included_channels, log_message, parse_orchestration
+from midi_reader import read_notes
+from pico_connection import StreamSender
+
+# the generator play_song() used to read files with, for comparison
+def generator_words(filename):
+    buffer = bytearray(128)
+    with open(filename, 'rb', buffering=0) as file:
+        while True:
+            n = file.readinto(buffer)
+            if n == 0:
+                break
+            i = 0
+            while i + 1 < n:
+                yield (buffer[i] << 8) | buffer[i + 1]
+                i += 2
+
+# counts the notes it is asked to play instead of playing them; delays are
+# left to whoever is calling, as play_song() handles them itself
+class CountingPlayer(MusicPlayer):
+    def __init__(self):
+        super().__init__()
+        self.words = 0
+
+    def play_word(self, word):
+        if word & 0xc000 != 0x8000:
+            self.words += 1
+
+def play_generator(filename):
+    player = CountingPlayer()
+    for word in generator_words(filename):
+        player.play_word(word)
+    return player.words
+
+# treat every word as due already, so what is measured is reading and decoding
+# the song rather than the stubs' emulation of the clock
+def play_file(filename):
+    player = CountingPlayer()
+    ticks_us, sleep_us = utime.ticks_us, utime.sleep_us
+    utime.ticks_us = lambda: 0
+    utime.sleep_us = lambda us: None
+    try:
+        player.play_song(filename)
+    finally:
+        utime.ticks_us, utime.sleep_us = ticks_us, sleep_us
+    return player.words
+
+def reset_clock():
+    utime.clock = utime.VirtualClock()
+    utime.timers.clear()
+    utime.timer_log.clear()
+
+# returns (seconds, peak bytes allocated, result) for the best of `repeat` runs; tracing
+# allocations slows Python down several times over, so the runs are timed without it
+# and the peak comes from one more run with tracemalloc on
+def measure(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        reset_clock()
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, result)
+    reset_clock()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best[0], peak, best[1]
+
+def bench_reader(args):
+    size = os.path.getsize(args.file)
+    print(f'{args.file}: {size} bytes, {size // 2} words')
+    for name, fn in (('generator', play_generator), ('play_song', play_file)):
+        elapsed, peak, words = measure(lambda: fn(args.file), args.repeat)
+        print(f'{name:10} {words:7} notes played  {elapsed * 1e6 / max(words, 1):6.2f} us/note  peak {peak / 1024:6.1f} KiB')
+
+# MusicPlayer.benchmark() times itself with ticks_us(), which must be the real clock here
+def bench_dispatch(args):
+    utime.clock = utime.RealClock()
+    words = benchmark_words(args.voices)
+    print(f'{len(words)} words of {args.voices}-note chords, best of {args.repeat}')
+    player = MusicPlayer()
+    us = min(player.benchmark(words) for _ in range(args.repeat))
+    print(f'play_word {us:6.2f} us/word')
+
+# the byte-at-a-time Pyboard.read_until() pyboard.py used to have, for comparison
+def legacy_read_until(pyboard, min_num_bytes, ending, timeout=10):
+    data = pyboard.serial.read(min_num_bytes)
+    timeout_count = 0
+    while True:
+        if data.endswith(ending):
+            break
+        elif pyboard.serial.inWaiting() > 0:
+            data = data + pyboard.serial.read(1)
+            timeout_count = 0
+        else:
+            timeout_count += 1
+            if timeout is not None and timeout_count >= 100 * timeout:
+                break
+            time.sleep(0.01)
+    return data
+
+def buffered_read_until(pyboard, min_num_bytes, ending, timeout=10):
+    return pyboard.read_until(min_num_bytes, ending, timeout)
+
+# times a round trip for a command printing size bytes, reading its output with each
+# version, on util/fake_pico.py run as a process (the same transport as Pyboard's exec:)
+def bench_repl(args):
+    pyboard = Pyboard('exec:{} {} --stdio'.format(sys.executable, os.path.join(UTIL_DIR, 'fake_pico.py')))
+    try:
+        pyboard.enter_raw_repl()
+        print(f'command round trips to a fake Pico over a pipe, best of {args.repeat}')
+        for size in args.sizes:
+            results = []
+            for name, read_until in (('byte-at-a-time', legacy_read_until), ('buffered', buffered_read_until)):
+                best = None
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    pyboard.exec_raw_no_follow(f"print('x' * {size - 2})")
+                    data = read_until(pyboard, 1, b'\x04')
+                    elapsed = time.perf_counter() - start
+                    pyboard.read_until(1, b'\x04')     # the (empty) error output
+                    if len(data) != size + 1:
+                        raise RuntimeError(f'read {len(data)} bytes, expected {size + 1}')
+                    best = elapsed if best is None else min(best, elapsed)
+                results.append(f'{name} {best * 1000:8.2f} ms')
+            print(f'{size:8} bytes  ' + '  '.join(results))
+    finally:
+        pyboard.close()
+
+# synthetic songs for the encoder benchmark, at 120 bpm: name -> (channels, ticks
+# between notes, notes at a time on each channel, ticks each note lasts, drives
+# in the orchestration, length compared with the others). Each channel is a track
+# of its own, as in most MIDI files.
+TICKS_PER_BEAT = 480
+CORPORA = {
+    'chords': (4, 120, 4, 120, 6, 1),       # dense four-note chords on every eighth note
+    'arpeggios': (2, 30, 1, 45, 4, 1),      # 64th-note runs, each note overlapping the next
+    'sustained': (3, 1920, 2, 1920, 6, 10), # a long piece of whole notes
+    'orchestra': (16, 240, 2, 200, 24, 1),  # every channel, played on enough drives for protocol 2
+}
+
+# the corpus as the bytes of a MIDI file (`seconds` long, times its length) and an
+# orchestration for it; the notes are random, but the same every time
+def synthetic_song(name, seconds):
+    channels, step, chord, length, drives, scale = CORPORA[name]
+    rng = random.Random(name)
+    midi = MidiFile(ticks_per_beat=TICKS_PER_BEAT)
+    end = seconds * scale * 2 * TICKS_PER_BEAT
+    for channel in range(channels):
+        events = []
+        for tick in range(0, end, step):
+            for note in rng.sample(range(36, 96), chord):
+                events.append((tick, Message('note_on', channel=channel, note=note, velocity=64)))
+                # both ways of releasing a note turn up in real files
+                off = 'note_off' if note & 1 else 'note_on'
+                events.append((tick + length, Message(off, channel=channel, note=note, velocity=0)))
+        track = MidiTrack()
+        if channel == 0:
+            track.append(MetaMessage('set_tempo', tempo=500000))
+        last = 0
+        for tick, msg in sorted(events, key=lambda event: (event[0], event[1].type == 'note_on')):
+            track.append(msg.copy(time=tick - last))
+            last = tick
+        midi.tracks.append(track)
+    data = io.BytesIO()
+    midi.save(file=data)
+    orchestration = [str((d % channels + 1) * (-1 if d // channels % 2 else 1)) for d in range(drives)]
+    return data.getvalue(), parse_orchestration(orchestration)
+
+def log_messages(orchestration, messages):
+    encoder = Encoder(orchestration)
+    channels = included_channels(orchestration)
+    for msg in messages:
+        log_message(encoder, msg, channels)
+    return encoder
+
+# times each stage of converting and streaming one synthetic song: parsing it with mido
+# (and for comparison, reading its notes with midi_reader, as convert_midi.py does),
+# logging its messages with the encoder (which encodes each event as it completes),
+# writing out the words (Encoder.write_output) and framing them into stream chunks
+def bench_encoder_stages(name, seconds, repeat):
+    data, orchestration = synthetic_song(name, seconds)
+    results = {}
+    def record(stage, fn, count, unit):
+        elapsed, peak, result = measure(fn, repeat)
+        results[stage] = {'seconds': round(elapsed, 6), unit + '_per_second': round(count / elapsed),
+                          'peak_kib': round(peak / 1024, 1)}
+        return result
+    messages = list(MidiFile(file=io.BytesIO(data)))
+    record('parse', lambda: list(MidiFile(file=io.BytesIO(data))), len(messages), 'messages')
+    channels = included_channels(orchestration)
+    notes = list(read_notes(data, channels)[0])
+    record('read', lambda: list(read_notes(data, channels)[0]), len(notes), 'notes')
+    record('events', lambda: log_messages(orchestration, messages), len(messages), 'messages')
+    output = write_output(log_messages(orchestration, messages))
+    words = [(output[i] << 8) | output[i + 1] for i in range(0, len(output), 2)]
+    # every run (and the traced one) needs an encoder with the whole song logged, and not yet written
+    encoders = [log_messages(orchestration, messages) for _ in range(repeat + 1)]
+    record('write_output', lambda: write_output(encoders.pop()), len(words), 'words')
+    record('framing', lambda: sum(1 for _ in StreamSender(None, verbose=False)._chunks(words)), len(words), 'words')
+    return len(messages), len(words), results
+
+def write_output(encoder):
+    out = io.BytesIO()
+    encoder.write_output(out)
+    return out.getvalue()
+
+def bench_encoder(args):
+    corpora = args.corpus or list(CORPORA)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    print(f'synthetic songs of {args.seconds} s (sustained: {args.seconds * CORPORA["sustained"][5]} s), best of {args.repeat}')
+    results = {}
+    slower = []
+    for name in corpora:
+        messages, words, stages = bench_encoder_stages(name, args.seconds, args.repeat)
+        results[name] = stages
+        print(f'{name}: {messages} messages, {words} words')
+        for stage, result in stages.items():
+            unit, rate = next((k, v) for k, v in result.items() if k.endswith('_per_second'))
+            line = f'  {stage:13} {result["seconds"] * 1000:9.2f} ms  {rate:9} {unit[:-11]}/s  peak {result["peak_kib"]:8.1f} KiB'
+            old = baseline.get(name, {}).get(stage) if baseline else None
+            if old:
+                change = (result['seconds'] / old['seconds'] - 1) * 100
+                line += f'  {change:+6.1f}% time'
+                if change > args.tolerance:
+                    line += '  SLOWER'
+                    slower.append(f'{name}/{stage}')
+            print(line)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'seconds': args.seconds, 'repeat': args.repeat,
+                       'python': sys.version.split()[0], 'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if slower:
+        sys.exit(f'slower than the baseline by more than {args.tolerance:g}%: {", ".join(slower)}')
+
+def main():
+    parser = ArgumentParser(description='Benchmark the floppy-music firmware on the host')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='report the best of this many runs')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    reader = subparsers.add_parser('reader', help='reading and decoding a .dat file in play_song()')
+    reader.add_argument('file', help='song file written by convert_midi.py')
+    reader.set_defaults(run=bench_reader)
+    dispatch = subparsers.add_parser('dispatch', help='playing notes in play_word()')
+    dispatch.add_argument('--voices', type=int, default=4, help='notes in each chord (at most Sound.DRIVES)')
+    dispatch.set_defaults(run=bench_dispatch)
+    repl = subparsers.add_parser('repl', help="reading a command's output in Pyboard.read_until(), "
+                                              'against the old byte-at-a-time version')
+    repl.add_argument('--sizes', type=lambda s: [int(n) for n in s.split(',')], default=[100, 4096, 65536, 262144],
+                      metavar='N,N,...', help='output sizes to time, in bytes')
+    repl.set_defaults(run=bench_repl)
+    encoder = subparsers.add_parser('encoder', help='each stage of converting synthetic MIDI files, '
+                                                    'from parsing to stream framing')
+    encoder.add_argument('--corpus', action='append', choices=list(CORPORA),
+                         help='synthetic song to convert; may be repeated (default: all of them)')
+    encoder.add_argument('--seconds', type=int, default=60, help='length of each song (default: 60)')
+    encoder.add_argument('--save', metavar='JSON', help='save the results, as a baseline to compare later runs with')
+    encoder.add_argument('--baseline', metavar='JSON',
+                         help='compare with results saved earlier, failing if any stage has slowed down by more than --tolerance')
+    encoder.add_argument('--tolerance', type=float, default=10, metavar='PERCENT',
+                         help='how much slower than the baseline a stage may be (default: 10)')
+    encoder.set_defaults(run=bench_encoder)
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
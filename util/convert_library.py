@@ -0,0 +1,152 @@
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import shlex
+import sys
+import time
+from convert_midi import add_encoder_arguments, add_cache_arguments, encoder_options, make_cache, parse_orchestration, convert_file
+from orchestrate import format_orchestration, suggest_file
+
+MIDI_SUFFIXES = ('.mid', '.midi')
+
+# a manifest has one song per line: the MIDI file (relative to the manifest)
+# followed by its orchestration, exactly as it would be passed to convert_midi.py;
+# blank lines and lines starting with # are ignored
+def read_manifest(path):
+    jobs = []
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            if len(fields) < 2:
+                raise ArgumentTypeError(f'{path}:{line_no}: expected a MIDI file followed by its orchestration')
+            jobs.append((path.parent / fields[0], parse_orchestration(fields[1:])))
+    return jobs
+
+# in a directory, each song's orchestration is read from a sidecar file with the
+# same name and an .orch extension, falling back to the one given on the command line
+def scan_directory(path, default_orchestration):
+    jobs = []
+    for midi_path in sorted(p for p in path.iterdir() if p.suffix.lower() in MIDI_SUFFIXES):
+        sidecar = midi_path.with_suffix('.orch')
+        if sidecar.exists():
+            orchestration = parse_orchestration(shlex.split(sidecar.read_text(), comments=True))
+        elif default_orchestration:
+            orchestration = default_orchestration
+        else:
+            raise ArgumentTypeError(f'no orchestration for {midi_path} (add {sidecar.name} or pass CHANNEL arguments)')
+        jobs.append((midi_path, orchestration))
+    return jobs
+
+# runs in a worker process; errors are reported rather than raised so one bad
+# song doesn't abort the rest of the library
+def convert_job(job):
+    infile, outfile, orchestration, options, cache = job
+    start = time.perf_counter()
+    try:
+        words = convert_file(infile, outfile, orchestration, options, cache)
+        return words, time.perf_counter() - start, None
+    except Exception as e:
+        return 0, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+
+# every MIDI file in a directory, or listed in a manifest, whatever their orchestrations
+def list_songs(source):
+    if source.is_dir():
+        return sorted(p for p in source.iterdir() if p.suffix.lower() in MIDI_SUFFIXES)
+    return [infile for infile, _ in read_manifest(source)]
+
+# runs in a worker process, like convert_job
+def suggest_job(job):
+    infile, drives, spread = job
+    start = time.perf_counter()
+    try:
+        _, coverage, orchestration = suggest_file(infile, drives, spread)
+        return coverage, orchestration, time.perf_counter() - start, None
+    except Exception as e:
+        return 0, None, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+
+# prints a manifest suggesting an orchestration for every song in the library, with
+# the songs relative to the directory (or the manifest's), so it can be saved there
+def suggest_library(source, drives, spread, workers):
+    base = source if source.is_dir() else source.parent
+    jobs = [(str(infile), drives, spread) for infile in list_songs(source)]
+    start = time.perf_counter()
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for job, (coverage, orchestration, elapsed, error) in zip(jobs, executor.map(suggest_job, jobs)):
+            name = shlex.quote(str(Path(job[0]).relative_to(base)))
+            if error:
+                failures += 1
+                print(f'# FAILED {name} ({elapsed:.2f}s): {error}')
+            elif not orchestration:
+                failures += 1
+                print(f'# FAILED {name} ({elapsed:.2f}s): no notes a drive could play')
+            else:
+                enough = f', {len(orchestration)} drives are enough' if len(orchestration) < drives else ''
+                print(f'{name} {format_orchestration(orchestration)}  '
+                      f'# {coverage:.0%} of the note time{enough} ({elapsed:.2f}s)')
+    print(f'# suggested orchestrations for {len(jobs) - failures} of {len(jobs)} songs '
+          f'in {time.perf_counter() - start:.2f}s' + (', to convert with --spread' if spread else ''))
+    return failures
+
+def main():
+    parser = ArgumentParser(description='Convert a library of MIDI files for floppy_music')
+    parser.add_argument('source', type=Path, help='directory of midi files, or a manifest listing files and their orchestrations')
+    parser.add_argument('outdir', type=Path, nargs='?', help='directory to write .dat files to')
+    parser.add_argument('orchestration', type=str, metavar='CHANNEL', nargs='*',
+                        help='default orchestration for songs in a directory that have no .orch file')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--suggest', type=int, default=None, metavar='N',
+                        help='instead of converting the songs, print a manifest with an orchestration for N drives for each')
+    add_encoder_arguments(parser)
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    if args.suggest is not None:
+        if args.suggest < 1:
+            parser.error('--suggest needs at least one drive')
+        try:
+            failures = suggest_library(args.source, args.suggest, args.spread, args.jobs)
+        except (ArgumentTypeError, OSError) as e:
+            parser.error(str(e))
+        if failures:
+            sys.exit(1)
+        return
+    if not args.outdir:
+        parser.error('the following arguments are required: outdir')
+
+    try:
+        default_orchestration = parse_orchestration(args.orchestration)
+        if args.source.is_dir():
+            songs = scan_directory(args.source, default_orchestration)
+        else:
+            songs = read_manifest(args.source)
+    except (ArgumentTypeError, OSError) as e:
+        parser.error(str(e))
+
+    args.outdir.mkdir(parents=True, exist_ok=True)
+    options = encoder_options(args)
+    cache = make_cache(args)
+    jobs = [(str(infile), str(args.outdir / (infile.stem + '.dat')), orchestration, options, cache)
+            for infile, orchestration in songs]
+    outfiles = [job[1] for job in jobs]
+    if len(set(outfiles)) != len(outfiles):
+        parser.error('two songs would be written to the same .dat file')
+
+    # results come back in manifest order no matter which worker finishes first
+    start = time.perf_counter()
+    failures = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for job, (words, elapsed, error) in zip(jobs, executor.map(convert_job, jobs)):
+            if error:
+                failures += 1
+                print(f'FAILED {job[0]} ({elapsed:.2f}s): {error}')
+            else:
+                print(f'{job[0]} -> {job[1]}: {words} words ({elapsed:.2f}s)')
+    print(f'converted {len(jobs) - failures} of {len(jobs)} songs in {time.perf_counter() - start:.2f}s')
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
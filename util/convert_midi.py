@@ -1,123 +1,298 @@
-from argparse import ArgumentParser
-from mido import MidiFile
-import re
-import io
-from pico_connection import PicoConnection
-
-parser = ArgumentParser(description='Convert MIDI file for floppy_music')
-parser.add_argument('infile', type=str, help='input midi file')
-parser.add_argument('outfile', type=str, help='output binary file, or use - to stream to the Pico')
-parser.add_argument('orchestration', type=str, metavar='CHANNEL', nargs='+',
-                    help='assign midi channels to drives (one argument per drive, each argument a comma-separated prioritized list; use a negative number to pick the lowest note in a chord)')
-args = parser.parse_args()
+from argparse import ArgumentParser, ArgumentTypeError
+from array import array
+from functools import lru_cache
+import asyncio
+import sys
+import time
+from midi_reader import read_notes
+from pico_connection import AsyncPicoConnection, PicoConnection
+from pico_cluster import PicoCluster, parse_board_drives, split_drives
+from orchestrate import format_orchestration, suggest_file
+from word_cache import WordCache
+
+# bump this whenever a change to the encoder alters its output,
+# so that stale entries in the conversion cache are never served
+ENCODER_VERSION = 2
+
+# MIDI note number -> drive frequency, folded by octaves into min_freq..max_freq;
+# built once per configuration and shared by every drive using it
+@lru_cache(maxsize=None)
+def note_frequency_table(min_freq, max_freq, a4=440.0):
+    if min_freq <= 0 or max_freq < min_freq * 2:
+        raise ValueError(f'frequency range {min_freq}..{max_freq} must span at least an octave')
+    if max_freq > 0x7FF:
+        raise ValueError(f'maximum frequency {max_freq} does not fit in a note-on word')
+    table = []
+    for midi_note in range(128):
+        freq = a4 * pow(2, (midi_note - 69.0) / 12)
+        while freq > max_freq:
+            freq /= 2
+        while freq < min_freq:
+            freq *= 2
+        table.append(round(freq))
+    return tuple(table)
+
+# the Pico's PIO programs take this many clock cycles per step, and its clock
+# dividers are 16.8 fixed point, limited to 1.0 up to (but not including) 65536.0;
+# these must match firmware/sound.py
+PIO_CYCLES_PER_STEP = 30
+DEFAULT_SYSCLK = 125000000
+
+# the 24-bit clock divider that steps a drive at freq Hz from a system clock
+# of sysclk Hz, as firmware/sound.py would work it out
+def clock_divider(sysclk, freq):
+    div = (sysclk * 256) // (freq * PIO_CYCLES_PER_STEP)
+    if div < 0x100 or div >= 0x1000000:
+        raise ValueError(f'{freq} Hz cannot be played with a {sysclk} Hz system clock')
+    return div
+
+# a note is identified by its channel and MIDI note number packed into one int,
+# so sets of notes can be tested for membership without comparing objects
+def note_key(midi_note, channel):
+    return (channel << 7) | midi_note
 
 class Note:
+    __slots__ = ('midi_note', 'channel', 'velocity', 'timestamp', 'key')
+
     def __init__(self, midi_note, channel, velocity=0, timestamp=0):
         self.midi_note = midi_note
         self.channel = channel
         self.velocity = velocity
         self.timestamp = timestamp
+        self.key = note_key(midi_note, channel)
 
     def __eq__(self, other):
         if not isinstance(other, Note):
             return False
-        
-        return self.midi_note == other.midi_note and self.channel == other.channel
+
+        return self.key == other.key
+
+    def __hash__(self):
+        return self.key
 
 class Event:
+    __slots__ = ('delay', 'timestamp', 'notes_on', 'notes_off')
+
     def __init__(self, delay, previous_timestamp):
         self.delay = delay
         self.timestamp = previous_timestamp + delay
         self.notes_on = []
-        self.notes_off = []
+        # keys (see note_key) of the notes released in this event
+        self.notes_off = set()
 
     def merge(self, prior_note_off_event):
         if prior_note_off_event.notes_on:
             raise RuntimeError('invalid merge')
         self.delay += prior_note_off_event.delay
-        self.notes_off.extend(prior_note_off_event.notes_off)
+        self.notes_off |= prior_note_off_event.notes_off
 
 class Encoder:
     MAX_FREQ=640
     MIN_FREQ=64
+    # protocol 1 has room for 16 voices in a note-on word and 12 in a notes-off
+    # word; songs for more drives than that are written with protocol 2
+    PROTOCOL_1_VOICES = 12
+    MAX_VOICES = 32
+
+    # how spread drives choose which of their notes to give up for a new one
+    STEAL_POLICIES = ('age', 'velocity')
 
-    def __init__(self, orchestration):
+    # freq_ranges optionally gives a (min, max) frequency pair per drive,
+    # for drives that can't handle the default step rates.
+    # If sysclk is given, every frequency a drive might play is checked against
+    # the Pico's clock dividers up front; with divider_table, the song also starts
+    # with a table of the dividers, and note-on words index into it.
+    # With spread, the drives are a pool rather than each following its channels on
+    # its own: notes starting together go to different drives, idle ones first, and
+    # only then replace the notes of busy drives, the oldest first (or with
+    # steal='velocity', the quietest).
+    def __init__(self, orchestration, a4=440.0, freq_ranges=None, sysclk=None, divider_table=False,
+                 spread=False, steal='age'):
         self.orchestration = orchestration
         self.num_drives = len(orchestration)
+        if self.num_drives > self.MAX_VOICES:
+            raise ValueError(f'at most {self.MAX_VOICES} drives are supported')
+        if freq_ranges is None:
+            freq_ranges = [(self.MIN_FREQ, self.MAX_FREQ)] * self.num_drives
+        self.a4 = a4
+        self.freq_ranges = freq_ranges
+        self.protocol = 1 if self.num_drives <= self.PROTOCOL_1_VOICES else 2
+        if self.protocol == 2:
+            for lo, hi in freq_ranges:
+                if hi > 0x3FF:
+                    raise ValueError(f'maximum frequency {hi} does not fit in a note-on word for more than {self.PROTOCOL_1_VOICES} drives')
+        self.frequency_tables = [note_frequency_table(lo, hi, a4) for lo, hi in freq_ranges]
         self.notes_playing = [None] * self.num_drives
-        self.events = []
+        if steal not in self.STEAL_POLICIES:
+            raise ValueError(f'unknown stealing policy: {steal}')
+        self.spread = spread
+        self.steal = steal
+        # for each drive, the priority of each channel it plays (0 first)
+        self.channel_ranks = []
+        for channels in orchestration:
+            ranks = {}
+            for rank, ch in enumerate(channels):
+                ranks.setdefault(abs(ch), rank)
+            self.channel_ranks.append(ranks)
+        # only the event currently being logged and a notes-off event awaiting
+        # a possible merge are kept; everything before them is already encoded
+        self.event = None
+        self.pending_note_off_event = None
+        self.words = []
+        # the time since the start of the song up to the last delay written, in
+        # seconds and as the milliseconds written for it
+        self.elapsed = 0.0
+        self.elapsed_ms = 0
+        self.divider_table = divider_table
+        if divider_table and not sysclk:
+            sysclk = DEFAULT_SYSCLK
+        self.sysclk = sysclk
+        self.frequency_index = None
+        if self.protocol != 1:
+            self._write_protocol()
+        if self.sysclk:
+            dividers = self._check_dividers()
+            if divider_table:
+                self._write_divider_table(dividers)
 
     def log_delay(self, delay):
-        if self.events and not self.events[-1].notes_on and not self.events[-1].notes_off:
-            self.events[-1].delay += delay
+        if self.event and not self.event.notes_on and not self.event.notes_off:
+            self.event.delay += delay
         else:
-            self.events.append(Event(delay, self._previous_timestamp()))
+            previous_event = self.event
+            self.event = Event(delay, self._previous_timestamp())
+            if previous_event:
+                self._process_event(previous_event)
 
     def log_note_on(self, note, channel, velocity):
         event = self._ensure_event()
         event.notes_on.append(Note(note, channel, velocity, timestamp=event.timestamp))
 
     def log_note_off(self, note, channel):
-        event = self._ensure_event()
-        event.notes_off.append(Note(note, channel, timestamp=event.timestamp))
+        self._ensure_event().notes_off.add(note_key(note, channel))
+
+    # encode everything logged so far, including the final event
+    def flush(self):
+        if self.event:
+            self._process_event(self.event)
+            self.event = None
+        if self.pending_note_off_event:
+            self._write_event(self.pending_note_off_event)
+            self.pending_note_off_event = None
+
+    # hand over the words encoded since the last call
+    def take_words(self):
+        words = self.words
+        self.words = []
+        return words
 
     def write_output(self, outfile):
-        self.outfile = outfile
-        pending_note_off_event = None
-        for event in self.events:
-            # if we have a note-off event followed by another event mere milliseconds later,
-            # postpone the notes-off until the next event and consolidate delay events
-            if pending_note_off_event:
-                if event.delay < 0.01:
-                    event.merge(pending_note_off_event)
-                else:
-                    self._write_event(pending_note_off_event)
-                pending_note_off_event = None
+        self.flush()
+        for word in self.take_words():
+            outfile.write(word.to_bytes(2, byteorder='big', signed=False))
 
-            # if this event is nothing but notes-off, see if we can merge it with the next one
-            if event.notes_off and not event.notes_on:
-                pending_note_off_event = event
+    def _process_event(self, event):
+        # if we have a note-off event followed by another event mere milliseconds later,
+        # postpone the notes-off until the next event and consolidate delay events
+        if self.pending_note_off_event:
+            if event.delay < 0.01:
+                event.merge(self.pending_note_off_event)
             else:
-                self._write_event(event)
+                self._write_event(self.pending_note_off_event)
+            self.pending_note_off_event = None
 
-        if pending_note_off_event:
-            self._write_event(pending_note_off_event)
+        # if this event is nothing but notes-off, see if we can merge it with the next one
+        if event.notes_off and not event.notes_on:
+            self.pending_note_off_event = event
+        else:
+            self._write_event(event)
 
     def _ensure_event(self):
-        if not self.events:
-            self.events.append(Event(0, 0))
-        return self.events[-1]
+        if not self.event:
+            self.event = Event(0, 0)
+        return self.event
 
     def _previous_timestamp(self):
-        if self.events:
-            return self.events[-1].timestamp
+        if self.event:
+            return self.event.timestamp
         return 0
 
-    def _find_note_for_voice(self, v, event):
-        # orchestration[v] is a prioritized list of MIDI channels assigned to voice v
-        # where minus n means pick the *lowest* playing note in channel n
+    # the notes starting in an event, as a bitmask of MIDI note numbers for each
+    # channel (so the highest and lowest are found without sorting), and by key
+    @staticmethod
+    def _index_notes(event):
+        masks = {}
+        notes = {}
+        for note in event.notes_on:
+            masks[note.channel] = masks.get(note.channel, 0) | (1 << note.midi_note)
+            notes.setdefault(note.key, note)
+        return masks, notes
+
+    # orchestration[v] is a prioritized list of MIDI channels assigned to voice v
+    # where minus n means pick the *lowest* playing note in channel n. With take,
+    # the note is removed from masks so that no other voice picks it.
+    def _find_note_for_voice(self, v, masks, notes, take=False):
         for ch in self.orchestration[v]:
-            notes = [note for note in event.notes_on if note.channel == abs(ch)]
-            notes.sort(key=lambda note: note.midi_note)
-            if notes:
-                return notes[-1] if ch > 0 else notes[0]
-        
+            channel = abs(ch)
+            mask = masks.get(channel)
+            if mask:
+                midi_note = mask.bit_length() - 1 if ch > 0 else (mask & -mask).bit_length() - 1
+                if take:
+                    masks[channel] = mask & ~(1 << midi_note)
+                return notes[note_key(midi_note, channel)]
+
         return None
 
+    # the note each voice starts in this event (or None), for spread drives
+    def _spread_notes(self, event, masks, notes):
+        notes_on = [None] * self.num_drives
+        idle = []
+        busy = []
+        for v, p in enumerate(self.notes_playing):
+            if p is None or p.key in event.notes_off:
+                idle.append(v)
+            elif p.key in notes:
+                # a note struck again while a voice is still playing it stays on that voice
+                notes_on[v] = notes[p.key]
+                masks[p.channel] &= ~(1 << p.midi_note)
+            else:
+                busy.append(v)
+        for v in idle:
+            notes_on[v] = self._find_note_for_voice(v, masks, notes, take=True)
+        if any(masks.values()):
+            if self.steal == 'velocity':
+                busy.sort(key=lambda v: (self.notes_playing[v].velocity, self.notes_playing[v].timestamp))
+            else:
+                busy.sort(key=lambda v: self.notes_playing[v].timestamp)
+            for v in busy:
+                note = self._find_note_for_voice(v, masks, notes)
+                if note and self._may_steal(v, note):
+                    notes_on[v] = self._find_note_for_voice(v, masks, notes, take=True)
+        return notes_on
+
+    # whether note may replace the one voice v is playing: only a note from a channel
+    # the voice gives at least as high a priority may
+    def _may_steal(self, v, note):
+        ranks = self.channel_ranks[v]
+        return ranks[note.channel] <= ranks[self.notes_playing[v].channel]
+
     def _write_event(self, event):
         # figure notes off, on, and retriggered
         notes_off_mask = 0
         retrigger_mask = 0
-        notes_on = [None] * self.num_drives
+        masks, notes = self._index_notes(event)
+        if self.spread:
+            notes_on = self._spread_notes(event, masks, notes)
+        else:
+            notes_on = [self._find_note_for_voice(v, masks, notes) for v in range(self.num_drives)]
         for v in range(self.num_drives):
-            if self.notes_playing[v] in event.notes_off:
+            if (p := self.notes_playing[v]) and p.key in event.notes_off:
                 notes_off_mask |= (1 << v)
 
-            note_on = self._find_note_for_voice(v, event)
+            note_on = notes_on[v]
             if note_on is not None:
-                if (p := self.notes_playing[v]) and p.midi_note == note_on.midi_note:
+                if p and p.midi_note == note_on.midi_note:
                     retrigger_mask |= (1 << v)
-                notes_on[v] = note_on
                 self.notes_playing[v] = note_on
                 notes_off_mask &= ~(1 << v)
 
@@ -143,54 +318,136 @@ class Encoder:
         if notes_off_mask != 0:
             self._write_notes_off(notes_off_mask)
 
-    def _note_frequency(self, midi_note):
-        freq = 440.0 * pow(2, (midi_note - 69.0) / 12)
-        while freq > self.MAX_FREQ:
-            freq /= 2
-        while freq < self.MIN_FREQ:
-            freq *= 2
-        return round(freq)
+    # everything that determines the output for a given MIDI file, in a normalized form
+    def settings(self):
+        settings = {
+            'version': ENCODER_VERSION,
+            'orchestration': self.orchestration,
+            'a4': self.a4,
+            'freq_ranges': [list(r) for r in self.freq_ranges],
+            'divider_table': self.sysclk if self.divider_table else None,
+        }
+        if self.spread:
+            # only present when set, so songs cached before there was a choice still match
+            settings['spread'] = self.steal
+        return settings
+
+    # the divider for every frequency any drive might play, in frequency order
+    def _check_dividers(self):
+        dividers = {}
+        for drive, table in enumerate(self.frequency_tables):
+            for freq in table:
+                if freq not in dividers:
+                    try:
+                        dividers[freq] = clock_divider(self.sysclk, freq)
+                    except ValueError as e:
+                        raise ValueError(f'drive {drive}: {e}')
+        return sorted(dividers.items())
+
+    # protocol revision: R = revision, which applies to the rest of the song;
+    # without one, a song is revision 1
+    # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+    #  1  1  0  1  1  1  1  1 R7 R6 R5 R4 R3 R2 R1 R0
+    def _write_protocol(self):
+        self._write16(0xDF00 | self.protocol)
+
+    # divider table: N = number of entries, followed by each 24-bit divider
+    # as two words holding its high and low 12 bits (so no word in the table
+    # can be mistaken for a delay); note-on F fields then index the table
+    # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+    #  1  1  0  1  0 NA N9 N8 N7 N6 N5 N4 N3 N2 N1 N0
+    def _write_divider_table(self, dividers):
+        self._write16(0xD000 | len(dividers))
+        for _, div in dividers:
+            self._write16(div >> 12)
+            self._write16(div & 0xFFF)
+        self.frequency_index = {freq: i for i, (freq, _) in enumerate(dividers)}
 
-    # note on: V = voice; F = frequency
+    # note on: V = voice; F = frequency (or divider table index)
     # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
-    #  0 V3 V2 V1 V0 FA F9 F8 F7 F6 F5 F4 F3 F2 F1 F0
+    #  0 V3 V2 V1 V0 FA F9 F8 F7 F6 F5 F4 F3 F2 F1 F0   (protocol 1)
+    #  0 V4 V3 V2 V1 V0 F9 F8 F7 F6 F5 F4 F3 F2 F1 F0   (protocol 2)
     def _write_note_on(self, voice, note):
-        u16 = (voice & 0xf) << 11
-        u16 |= self._note_frequency(note)
+        if self.protocol == 1:
+            u16 = (voice & 0xf) << 11
+        else:
+            u16 = (voice & 0x1f) << 10
+        freq = self.frequency_tables[voice][note]
+        if self.frequency_index is not None:
+            u16 |= self.frequency_index[freq]
+        else:
+            u16 |= freq
         self._write16(u16)
 
     # delay: D = delay in milliseconds
     # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
     #  1  0 DD DC DB DA D9 D8 D7 D6 D5 D4 D3 D2 D1 D0
+    # each delay is rounded to where the song has got to rather than on its own, so
+    # rounding errors don't add up over a long song
     def _write_delay(self, delay):
-        delay = round(delay * 1000)
+        self.elapsed += delay
+        delay = round(self.elapsed * 1000) - self.elapsed_ms
+        self.elapsed_ms += delay
         while delay > 0x3FFF:
             self._write16(0xBFFF)
             delay -= 0x3FFF
         if delay > 0:
             self._write16(0x8000 | delay)
 
-    # notes off: C = channel; V = voice mask
+    # notes off: V = voice mask, for voices 0-11
     # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
     #  1  1  0  0 VB VA V9 V8 V7 V6 V5 V4 V3 V2 V1 V0
+    # bank notes off (protocol 2): B = bank; V = mask of voices 12 + 10 * B onwards
+    # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+    #  1  1  1  0 B1 B0 V9 V8 V7 V6 V5 V4 V3 V2 V1 V0
     def _write_notes_off(self, voice_mask):
-        self._write16(0xC000 | voice_mask)
+        if voice_mask & 0xFFF:
+            self._write16(0xC000 | (voice_mask & 0xFFF))
+        voice_mask >>= 12
+        bank = 0
+        while voice_mask:
+            if voice_mask & 0x3FF:
+                self._write16(0xE000 | (bank << 10) | (voice_mask & 0x3FF))
+            voice_mask >>= 10
+            bank += 1
 
     def _write16(self, u16):
-        self.outfile.write(u16.to_bytes(2, byteorder='big', signed=False))
+        self.words.append(u16)
+
+# read the notes straight out of a MIDI file's bytes with midi_reader and yield encoded
+# words as soon as each event is complete, so playback can begin long before the end
+# of the song has been encoded
+def encode_smf(data, encoder):
+    notes, length = read_notes(data, included_channels(encoder.orchestration))
+    now = 0.0
+    for seconds, channel, note, velocity in notes:
+        if seconds > now:
+            encoder.log_delay(seconds - now)
+            now = seconds
+            yield from encoder.take_words()
+        if velocity:
+            encoder.log_note_on(note, channel, velocity)
+        else:
+            encoder.log_note_off(note, channel)
+    # the song lasts until its longest track ends, as it does through mido
+    if length > now:
+        encoder.log_delay(length - now)
+    encoder.flush()
+    yield from encoder.take_words()
 
-midi = MidiFile(args.infile)
+# the MIDI channels an orchestration plays from
+def included_channels(orchestration):
+    return set([abs(ch) for sublist in orchestration for ch in sublist])
 
-# NOTE: 1 is added to channels to match user-visible channel numbers in e.g. MuseScore
-orchestration = [[int(ch) for ch in drive.split(',')] for drive in args.orchestration]
-included_channels = set([abs(ch) for sublist in orchestration for ch in sublist])
-encoder = Encoder(orchestration)
-for msg in midi:
+# hand one mido message to the encoder. Songs are read with midi_reader now; this
+# is kept for util/benchmark.py, whose events stage times the encoder on mido messages
+def log_message(encoder, msg, channels):
     if msg.time > 0:
         encoder.log_delay(msg.time)
     if not msg.is_meta:
+        # NOTE: 1 is added to channels to match user-visible channel numbers in e.g. MuseScore
         channel = msg.channel + 1
-        if channel in included_channels:
+        if channel in channels:
             if msg.type == 'note_on':
                 if msg.velocity == 0:
                     encoder.log_note_off(msg.note, channel)
@@ -199,10 +456,242 @@ for msg in midi:
             elif msg.type == 'note_off':
                 encoder.log_note_off(msg.note, channel)
 
-if args.outfile == '-':
-    buf = io.BytesIO()
-    encoder.write_output(buf)
-    buf.seek(0, io.SEEK_SET)
-    PicoConnection().play_song(buf)
-else:
-    encoder.write_output(open(args.outfile, 'wb'))
+def parse_orchestration(drives):
+    try:
+        return [[int(ch) for ch in drive.split(',')] for drive in drives]
+    except ValueError:
+        raise ArgumentTypeError(f'invalid orchestration: {" ".join(drives)}')
+
+def parse_freq_ranges(specs, num_drives):
+    ranges = [(Encoder.MIN_FREQ, Encoder.MAX_FREQ)] * num_drives
+    for spec in specs:
+        drive, _, span = spec.rpartition('=')
+        try:
+            lo, hi = (int(f) for f in span.split(':'))
+            drives = [int(drive)] if drive else range(num_drives)
+        except ValueError:
+            raise ArgumentTypeError(f'invalid frequency range: {spec}')
+        for d in drives:
+            if d < 0 or d >= num_drives:
+                raise ArgumentTypeError(f'no drive {d} in the orchestration')
+            ranges[d] = (lo, hi)
+    return ranges
+
+def add_encoder_arguments(parser):
+    parser.add_argument('--a4', type=float, default=440.0, metavar='HZ',
+                        help='tuning reference for A4 (default 440)')
+    parser.add_argument('--freq-range', type=str, action='append', default=[], metavar='[DRIVE=]MIN:MAX',
+                        help='fold notes into MIN..MAX Hz, for all drives or just the given (0-based) drive; may be repeated')
+    parser.add_argument('--sysclk', type=int, default=None, metavar='HZ',
+                        help=f"check that every note can be played with the Pico's system clock at HZ (default {DEFAULT_SYSCLK} with --divider-table)")
+    parser.add_argument('--divider-table', action='store_true',
+                        help='work out the clock divider for each note here, so the Pico needs no arithmetic to play it')
+    parser.add_argument('--spread', action='store_true',
+                        help='share notes starting together between the drives playing their channel, rather than every drive taking the same one')
+    parser.add_argument('--steal', choices=Encoder.STEAL_POLICIES, default='age',
+                        help='with --spread, which note a busy drive gives up for a new one: the oldest (default) or the quietest')
+
+# the encoder settings as plain values, so they can be handed to worker processes
+def encoder_options(args):
+    return {'a4': args.a4, 'freq_range': list(args.freq_range),
+            'sysclk': args.sysclk, 'divider_table': args.divider_table,
+            'spread': args.spread, 'steal': args.steal}
+
+def make_encoder(orchestration, options):
+    freq_ranges = parse_freq_ranges(options['freq_range'], len(orchestration))
+    return Encoder(orchestration, options['a4'], freq_ranges, options['sysclk'], options['divider_table'],
+                   options['spread'], options['steal'])
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache-dir', type=str, default=None, metavar='DIR',
+                        help='where to cache converted songs (default ~/.cache/floppy-music)')
+    parser.add_argument('--cache-size', type=int, default=64, metavar='MB',
+                        help='maximum size of the conversion cache; the least recently used songs are evicted first (default 64)')
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the conversion cache")
+
+def make_cache(args):
+    if args.no_cache or args.cache_size <= 0:
+        return None
+    return WordCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+def words_to_bytes(words):
+    data = array('H', words)
+    if sys.byteorder == 'little':
+        data.byteswap()
+    return data.tobytes()
+
+def words_from_bytes(data):
+    words = array('H')
+    words.frombytes(data[:len(data) & ~1])
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words
+
+# yield the words for a MIDI file, serving repeat conversions from the cache;
+# a freshly encoded song is only cached once it has been consumed completely
+def encode_file(infile, encoder, cache=None):
+    with open(infile, 'rb') as f:
+        midi_data = f.read()
+    if cache:
+        key = cache.key(midi_data, encoder.settings())
+        cached = cache.get(key)
+        if cached is not None:
+            yield from words_from_bytes(cached)
+            return
+    words = array('H')
+    for word in encode_smf(midi_data, encoder):
+        words.append(word)
+        yield word
+    if cache:
+        cache.put(key, words_to_bytes(words))
+
+# convert one MIDI file to a .dat file, returning the number of words written
+def write_file(infile, outfile, encoder, cache=None):
+    data = words_to_bytes(encode_file(infile, encoder, cache))
+    with open(outfile, 'wb') as f:
+        f.write(data)
+    return len(data) // 2
+
+def convert_file(infile, outfile, orchestration, options, cache=None):
+    return write_file(infile, outfile, make_encoder(orchestration, options), cache)
+
+# how many words the Pico keeps timings for when --jitter is given
+JITTER_LOG_SIZE = 4096
+
+def write_jitter(samples, filename):
+    late = PicoConnection.lateness(samples)
+    with open(filename, 'w') as f:
+        f.write('scheduled_us,actual_us,late_us\n')
+        for (scheduled, actual), l in zip(samples, late):
+            f.write(f'{scheduled},{actual},{l}\n')
+    if late:
+        ordered = sorted(late)
+        n = len(ordered)
+        print(f'lateness over {n} words: p50 {ordered[n // 2]} us, p99 {ordered[n * 99 // 100]} us, max {ordered[-1]} us')
+
+# the single-board streaming path, through AsyncPicoConnection; songs are played
+# one after another in the same session
+async def stream_async(device, songs, jitter, drives, fresh):
+    pico = await AsyncPicoConnection.connect(device)
+    try:
+        await pico.open_session(drives, fresh)
+        for words in songs:
+            await pico.play_song(words, jitter_log=JITTER_LOG_SIZE if jitter else 0, drives=drives)
+        if jitter:
+            write_jitter(await pico.fetch_jitter(), jitter)
+    finally:
+        pico.close()
+
+# prints what is in each channel and the orchestration that plays the most of the song
+# on the given number of drives, ready to paste after the output file name
+def suggest_orchestration(infile, drives, spread=False):
+    start = time.perf_counter()
+    analysis, coverage, orchestration = suggest_file(infile, drives, spread)
+    for channel in sorted(analysis.stats):
+        print(analysis.stats[channel].describe(analysis.length), file=sys.stderr)
+    if not orchestration:
+        sys.exit(f'suggest: {infile} has no notes a drive could play')
+    print(f'suggest: {len(orchestration)} drives play {coverage:.0%} of the note time '
+          f'(found in {time.perf_counter() - start:.2f}s)', file=sys.stderr)
+    if len(orchestration) < drives:
+        print(f'suggest: {len(orchestration)} drives are enough; '
+              f'the other {drives - len(orchestration)} would have nothing more to play', file=sys.stderr)
+    print(format_orchestration(orchestration) + (' --spread' if spread else ''))
+
+def main():
+    parser = ArgumentParser(description='Convert MIDI file for floppy_music')
+    parser.add_argument('infile', type=str, help='input midi file')
+    parser.add_argument('outfile', type=str, nargs='?', help='output binary file, or use - to stream to the Pico')
+    parser.add_argument('orchestration', type=str, metavar='CHANNEL', nargs='*',
+                        help='assign midi channels to drives (one argument per drive, each argument a comma-separated prioritized list; use a negative number to pick the lowest note in a chord)')
+    parser.add_argument('--device', type=str, action='append', default=[],
+                        help='serial port of the Pico to stream to (default: the first one found); '
+                             'repeat it to play across several boards')
+    parser.add_argument('--cluster', action='store_true',
+                        help='play across every Pico connected, each taking the next few drives')
+    parser.add_argument('--board-drives', type=str, default=None, metavar='N,N,...',
+                        help='how many drives each board in a cluster has (default: shared out evenly)')
+    parser.add_argument('--jitter', type=str, default=None, metavar='CSV',
+                        help='when streaming, record how late the Pico plays each word and save it as CSV')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='stream to a single board with the asyncio transport, which waits on the port rather than polling it')
+    parser.add_argument('--then', type=str, action='append', default=[], metavar='MIDI',
+                        help='when streaming, play this file next, in the same session (can be repeated)')
+    parser.add_argument('--fresh', action='store_true',
+                        help="when streaming, soft-reset the Pico and set up a new player instead of reusing the last one's")
+    parser.add_argument('--suggest', type=int, default=None, metavar='N',
+                        help='instead of converting the song, analyse it and print an orchestration for N drives')
+    add_encoder_arguments(parser)
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    if args.suggest is not None:
+        if args.suggest < 1:
+            parser.error('--suggest needs at least one drive')
+        try:
+            suggest_orchestration(args.infile, args.suggest, args.spread)
+        except OSError as e:
+            parser.error(str(e))
+        return
+    if not args.outfile or not args.orchestration:
+        parser.error('the following arguments are required: outfile, CHANNEL')
+
+    try:
+        orchestration = parse_orchestration(args.orchestration)
+        options = encoder_options(args)
+        encoder = make_encoder(orchestration, options)
+    except (ArgumentTypeError, ValueError) as e:
+        parser.error(str(e))
+    cache = make_cache(args)
+    # an encoder carries each song's state and writes its headers when it is created,
+    # so every song gets a fresh one
+    songs = (encode_file(infile, make_encoder(orchestration, options), cache)
+             for infile in [args.infile] + args.then)
+    if args.then and args.outfile != '-':
+        parser.error('--then only works when streaming')
+    if args.then and args.jitter:
+        parser.error('--jitter only works with a single song')
+
+    if args.outfile == '-' and (args.cluster or len(args.device) > 1):
+        if args.jitter:
+            parser.error('--jitter only works with a single board')
+        cluster = PicoCluster(args.device)
+        try:
+            if args.board_drives:
+                drive_counts = parse_board_drives(args.board_drives)
+            else:
+                drive_counts = split_drives(len(orchestration), len(cluster.connections))
+            if sum(drive_counts) < len(orchestration):
+                parser.error(f'the boards have {sum(drive_counts)} drives but the orchestration needs {len(orchestration)}')
+            if args.fresh:
+                for connection, drives in zip(cluster.connections, drive_counts):
+                    connection.open_session(drives, fresh=True)
+            for words in songs:
+                if not cluster.play_song(words, drive_counts):
+                    break
+        except ValueError as e:
+            parser.error(str(e))
+        finally:
+            cluster.close()
+    elif args.outfile == '-' and args.use_async:
+        try:
+            asyncio.run(stream_async(args.device[0] if args.device else None,
+                                     songs, args.jitter, len(orchestration), args.fresh))
+        except KeyboardInterrupt:
+            pass
+    elif args.outfile == '-':
+        pico = PicoConnection(args.device[0] if args.device else None)
+        try:
+            pico.open_session(len(orchestration), args.fresh)
+            for words in songs:
+                if not pico.play_song(words, jitter_log=JITTER_LOG_SIZE if args.jitter else 0, drives=len(orchestration)):
+                    break
+            if args.jitter:
+                write_jitter(pico.fetch_jitter(), args.jitter)
+        finally:
+            pico.close()
+    else:
+        write_file(args.infile, args.outfile, encoder, cache)
+
+if __name__ == '__main__':
+    main()
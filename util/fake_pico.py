@@ -0,0 +1,180 @@
+# A stand-in for a Pico running the floppy-music firmware, for trying out the host
+# side without hardware. It creates a pty, prints its path, and answers on it the way
+# MicroPython's raw REPL does, running the real firmware against the stub hardware
+# modules in util/stubs. Point the host at it with e.g.
+#   python3 util/convert_midi.py song.mid - 1 2 --device /dev/pts/5
+from argparse import ArgumentParser
+import os
+import sys
+import traceback
+import tty
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE_DIR = os.path.join(os.path.dirname(UTIL_DIR), 'firmware')
+FIRMWARE_MODULES = ('music_player', 'sound')
+
+RAW_REPL_BANNER = b'raw REPL; CTRL-B to exit\r\n'
+RAW_PASTE_WINDOW = 128
+
+# the board end of the serial link; written to through write_fd, if given
+class Port:
+    def __init__(self, fd, write_fd=None):
+        self.fd = fd
+        self.write_fd = fd if write_fd is None else write_fd
+        self.pending = bytearray()
+
+    def fileno(self):
+        return self.fd
+
+    # never reads ahead of what was asked for, so that polling the fd
+    # tells the firmware whether there is more data to come
+    def read(self, n):
+        while len(self.pending) < n:
+            data = os.read(self.fd, n - len(self.pending))
+            if not data:
+                raise EOFError
+            self.pending += data
+        data = bytes(self.pending[:n])
+        del self.pending[:n]
+        return data
+
+    def readinto(self, buf):
+        buf[:] = self.read(len(buf))
+        return len(buf)
+
+    def write(self, data):
+        data = bytes(data)
+        written = 0
+        while written < len(data):
+            written += os.write(self.write_fd, data[written:])
+        return written
+
+    def flush(self):
+        pass
+
+# what the firmware sees as sys.stdin and sys.stdout
+class Stdio:
+    def __init__(self, port):
+        self.port = port
+        self.buffer = port
+
+    def fileno(self):
+        return self.port.fileno()
+
+    def read(self, n=1):
+        return self.port.read(n).decode('latin-1')
+
+    def write(self, text):
+        self.port.write(text.replace('\n', '\r\n').encode())
+        return len(text)
+
+    def flush(self):
+        pass
+
+class FakePico:
+    def __init__(self, fd, write_fd=None):
+        self.port = Port(fd, write_fd)
+        self.namespace = {}
+
+    def run(self):
+        raw = False
+        while True:
+            c = self.port.read(1)
+            if c == b'\x01':
+                raw = True
+                self.port.write(RAW_REPL_BANNER + b'>')
+            elif c == b'\x02':
+                raw = False
+                self.port.write(b'\r\nMicroPython (fake_pico)\r\n>>> ')
+            elif raw and c == b'\x04':
+                self.soft_reset()
+                self.port.write(b'OK\r\nMPY: soft reboot\r\n' + RAW_REPL_BANNER + b'>')
+            elif raw and c == b'\x05':
+                self.port.read(2)  # 'A\x01'
+                self.port.write(b'R\x01' + RAW_PASTE_WINDOW.to_bytes(2, 'little'))
+                self.execute(self.read_raw_paste())
+            elif raw and c not in b'\r\x03':
+                code = self.read_raw(c)
+                self.port.write(b'OK')
+                self.execute(code)
+
+    def read_raw(self, code):
+        while not code.endswith(b'\x04'):
+            code += self.port.read(1)
+        return code[:-1]
+
+    def read_raw_paste(self):
+        code = bytearray()
+        remain = RAW_PASTE_WINDOW
+        while True:
+            c = self.port.read(1)
+            if c == b'\x04':
+                self.port.write(b'\x04')
+                return bytes(code)
+            code += c
+            remain -= 1
+            if remain == 0:
+                remain = RAW_PASTE_WINDOW
+                self.port.write(b'\x01')
+
+    def execute(self, code):
+        stdio = Stdio(self.port)
+        saved = sys.stdin, sys.stdout
+        sys.stdin = sys.stdout = stdio
+        error = b''
+        try:
+            exec(compile(code, '<stdin>', 'exec'), self.namespace)
+        except SystemExit:
+            raise
+        except BaseException:
+            error = traceback.format_exc().replace('\n', '\r\n').encode()
+        finally:
+            sys.stdin, sys.stdout = saved
+        self.port.write(b'\x04' + error + b'\x04>')
+
+    def soft_reset(self):
+        import utime
+        if utime.timer_log:
+            late = [fired - due for _, due, fired in utime.timer_log]
+            print('{} timer callbacks, up to {} us late'.format(len(late), max(late)), file=sys.stderr)
+        utime.timer_log.clear()
+        utime.timers.clear()
+        self.namespace = {'__name__': '__main__'}
+        for name in FIRMWARE_MODULES:
+            sys.modules.pop(name, None)
+
+def main():
+    parser = ArgumentParser(description='Emulate a floppy-music Pico on a pty')
+    parser.add_argument('--virtual-clock', action='store_true',
+                        help='run the firmware on a simulated clock, so songs play as fast as the host can send them')
+    parser.add_argument('--drift', type=float, default=0, metavar='PPM',
+                        help="run the board's clock fast (or slow, if negative) by this many parts per million")
+    parser.add_argument('--rp2350', action='store_true',
+                        help='emulate an RP2350, which has a third PIO block (and so room for 12 drives)')
+    parser.add_argument('--stdio', action='store_true',
+                        help="answer on stdin and stdout instead of a pty, for use as Pyboard's exec:python3 util/fake_pico.py --stdio")
+    args = parser.parse_args()
+
+    sys.path[:0] = [os.path.join(UTIL_DIR, 'stubs'), FIRMWARE_DIR]
+    import utime
+    if args.virtual_clock:
+        utime.clock = utime.VirtualClock()
+    elif args.drift:
+        utime.clock = utime.RealClock(1 + args.drift / 1000000)
+    if args.rp2350:
+        import rp2
+        rp2.PIO_BLOCKS = 3
+    if args.stdio:
+        pico = FakePico(sys.stdin.fileno(), sys.stdout.fileno())
+    else:
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        print(os.ttyname(slave), flush=True)
+        pico = FakePico(master)
+    try:
+        pico.run()
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+if __name__ == '__main__':
+    main()
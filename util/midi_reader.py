@@ -0,0 +1,148 @@
+# Reads the notes straight out of a Standard MIDI File. mido parses every message of
+# every track into an object, merges the tracks into one list and hands back each
+# message's delay as float seconds; here each track is walked as bytes, keeping only
+# the notes on the channels wanted, the tracks are merged lazily with a heap, and each
+# note's tick is turned into time from the start of the song through a tempo map
+# worked out beforehand, in integer arithmetic, so times never drift however long the
+# song is.
+from heapq import merge
+from operator import itemgetter
+
+# microseconds per beat until a set_tempo says otherwise
+DEFAULT_TEMPO = 500000
+
+# reads a variable-length quantity at pos, returning (value, position after it)
+def _read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+# walks one track, returning its notes as (tick, channel, note, velocity), with a
+# velocity of 0 for a note off, and the tick it ends on; tempo changes are appended
+# to tempos as (tick, tempo). Other messages are stepped over without being decoded.
+def _read_track(data, channels, tempos):
+    notes = []
+    tick = pos = status = 0
+    end = len(data)
+    while pos < end:
+        delta, pos = _read_varlen(data, pos)
+        tick += delta
+        byte = data[pos]
+        if byte >= 0xF0:
+            pos += 1
+            if byte == 0xFF:
+                kind = data[pos]
+                length, pos = _read_varlen(data, pos + 1)
+                if kind == 0x51 and length == 3:
+                    tempos.append((tick, int.from_bytes(data[pos:pos + 3], 'big')))
+                elif kind == 0x2F:
+                    break
+            elif byte in (0xF0, 0xF7):
+                length, pos = _read_varlen(data, pos)
+            else:
+                raise ValueError(f'unexpected status byte {byte:#04x}')
+            pos += length
+            continue
+        if byte >= 0x80:
+            status = byte
+            pos += 1
+        elif not status:
+            raise ValueError('running status with no previous status byte')
+        kind = status & 0xF0
+        if kind == 0x90 or kind == 0x80:
+            # channels are numbered from 1, as convert_midi.py takes them
+            channel = (status & 0x0F) + 1
+            if channels is None or channel in channels:
+                notes.append((tick, channel, data[pos], data[pos + 1] if kind == 0x90 else 0))
+            pos += 2
+        elif kind == 0xC0 or kind == 0xD0:
+            pos += 1
+        else:
+            pos += 2
+    return notes, tick
+
+# the track chunks of a MIDI file, as (format, division, [track data])
+def read_chunks(data):
+    data = memoryview(data)
+    if bytes(data[:4]) != b'MThd' or len(data) < 14:
+        raise ValueError('not a MIDI file')
+    size = int.from_bytes(data[4:8], 'big')
+    fmt = int.from_bytes(data[8:10], 'big')
+    num_tracks = int.from_bytes(data[10:12], 'big')
+    division = int.from_bytes(data[12:14], 'big')
+    tracks = []
+    pos = 8 + size
+    while len(tracks) < num_tracks and pos + 8 <= len(data):
+        size = int.from_bytes(data[pos + 4:pos + 8], 'big')
+        # chunks of any other type are to be skipped
+        if bytes(data[pos:pos + 4]) == b'MTrk':
+            tracks.append(data[pos + 8:pos + 8 + size])
+        pos += 8 + size
+    return fmt, division, tracks
+
+# the notes of a MIDI file on the given channels (all of them, if None) in the order
+# mido would play them, as (seconds from the start, channel, note, velocity) with a
+# velocity of 0 for a note off; returns (notes, length of the song in seconds)
+def read_notes(data, channels=None):
+    fmt, division, tracks = read_chunks(data)
+    if fmt == 2:
+        raise ValueError("can't merge the tracks of a type 2 (asynchronous) MIDI file")
+    tempos = []
+    track_notes = []
+    end_tick = 0
+    for track in tracks:
+        # tempo changes count wherever they are, and the song lasts until its longest
+        # track ends, so every track is walked; only those with wanted notes are merged
+        track_tempos = []
+        notes, last_tick = _read_track(track, channels, track_tempos)
+        tempos.append(track_tempos)
+        end_tick = max(end_tick, last_tick)
+        if notes:
+            track_notes.append(notes)
+    tempo_map = _tempo_map(merge(*tempos, key=itemgetter(0)), division)
+    notes = merge(*track_notes, key=itemgetter(0))
+    return _timed(notes, tempo_map), _time(end_tick, tempo_map, 0)[0]
+
+# the tempo map as (tick, time) at each tempo change, with time as a fraction of a
+# second held as (numerator, denominator, tempo) so ticks convert exactly; a negative
+# division gives SMPTE frames per second and ticks per frame, with no tempo at all
+def _tempo_map(tempos, division):
+    if division & 0x8000:
+        fps = 256 - (division >> 8)
+        ticks_per_frame = division & 0xFF
+        # 29 means drop-frame, at 29.97 frames a second
+        if fps == 29:
+            return [(0, 0, ticks_per_frame * 2997, 100)]
+        return [(0, 0, ticks_per_frame * fps, 1)]
+    # time in microseconds * division, so each segment adds ticks * tempo exactly
+    tempo_map = [(0, 0, division * 1000000, DEFAULT_TEMPO)]
+    for tick, tempo in tempos:
+        start, numerator, denominator, previous = tempo_map[-1]
+        numerator += (tick - start) * previous
+        if tick == start:
+            tempo_map[-1] = (tick, numerator, denominator, tempo)
+        else:
+            tempo_map.append((tick, numerator, denominator, tempo))
+    return tempo_map
+
+# the time of tick in seconds, searching tempo_map from segment onwards; returns
+# (seconds, segment the tick is in) so monotonic ticks walk the map only once
+def _time(tick, tempo_map, segment):
+    while segment + 1 < len(tempo_map) and tempo_map[segment + 1][0] <= tick:
+        segment += 1
+    start, numerator, denominator, rate = tempo_map[segment]
+    return (numerator + (tick - start) * rate) / denominator, segment
+
+def _timed(notes, tempo_map):
+    segment = 0
+    last_tick = -1
+    seconds = 0.0
+    for tick, channel, note, velocity in notes:
+        if tick != last_tick:
+            seconds, segment = _time(tick, tempo_map, segment)
+            last_tick = tick
+        yield seconds, channel, note, velocity
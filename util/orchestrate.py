@@ -0,0 +1,303 @@
+# Suggests an orchestration for a MIDI file. The song is analysed once, into how many
+# notes each channel has sounding at every moment and which notes start and stop at
+# each point in it; the search then looks for the drives' channel lists (in the form
+# convert_midi.py takes them) under which the drives between them play as much of the
+# song's note time as possible.
+#
+# A drive picks up the highest note (the lowest, if the channel is negative) of its
+# first channel with any notes starting, falling back to a second channel while the
+# first starts nothing, and plays it until the note is released or it picks up
+# another: a note still sounding in its first channel doesn't stop it taking one
+# starting in its fallback. Each drive follows its channels on its own, so drives
+# given the same channel and sign play the same notes. With --spread, the drives
+# share out the notes sounding in each channel instead, each playing a different one.
+#
+# Either way the song comes down to groups: a stretch of time during which the
+# drives in a group would play the same note (or with --spread, share out a
+# channel's notes, as many of them as it has), and which counts as covered for each
+# drive of the group that is used, up to the number of notes. The search keeps how
+# many drives of each group are in use, and how much each candidate drive would add;
+# adding or removing a drive only updates the groups it belongs to, and the gains
+# of the drives that share them.
+from itertools import chain
+from midi_reader import read_notes
+
+# General MIDI puts percussion on channel 10, whose note numbers are drums rather
+# than pitches; it is never suggested
+PERCUSSION_CHANNEL = 10
+# the search stops improving an orchestration after this many passes over its drives
+MAX_PASSES = 5
+
+class ChannelStats:
+    def __init__(self, channel):
+        self.channel = channel
+        self.notes = 0
+        self.lowest = None
+        self.highest = None
+        self.max_polyphony = 0
+        self.sounding_seconds = 0.0  # time with at least one note sounding...
+        self.note_seconds = 0.0      # ...and the total length of its notes
+
+    def describe(self, length):
+        if not self.notes:
+            return f'channel {self.channel:2}: no notes'
+        return (f'channel {self.channel:2}: {self.notes:5} notes ({self.notes / max(length, 1e-9):5.1f}/s), '
+                f'range {self.lowest}-{self.highest}, sounding {self.sounding_seconds / max(length, 1e-9):4.0%} '
+                f'of the time, up to {self.max_polyphony} at once '
+                f'(average {self.note_seconds / max(self.sounding_seconds, 1e-9):.1f})'
+                + (', percussion' if self.channel == PERCUSSION_CHANNEL else ''))
+
+class Analysis:
+    def __init__(self, data):
+        self.stats = {}
+        states = {}                 # note counts, one per channel in channel order -> seconds
+        sounding = {}               # channel -> {MIDI note: times struck and not yet released}
+        # (seconds, {channel: (lowest, highest) note starting}, {(channel, note) released})
+        # at each point in the song where notes start or stop, leaving out percussion
+        self.events = []
+        notes, self.length = read_notes(data)
+        now = 0.0
+        # the song's length comes last, so a note still held at the end counts until then
+        for seconds, channel, note, velocity in chain(notes, [(self.length, None, 0, 0)]):
+            if seconds > now:
+                if sounding:
+                    for c, held in sounding.items():
+                        stats = self.stats[c]
+                        stats.sounding_seconds += seconds - now
+                        stats.note_seconds += (seconds - now) * len(held)
+                    state = tuple(sorted((c, len(held)) for c, held in sounding.items()))
+                    states[state] = states.get(state, 0.0) + seconds - now
+                now = seconds
+            if channel is None:
+                break
+            if channel != PERCUSSION_CHANNEL:
+                if not self.events or self.events[-1][0] != seconds:
+                    self.events.append((seconds, {}, set()))
+                _, starts, released = self.events[-1]
+                if velocity:
+                    low, high = starts.get(channel, (note, note))
+                    starts[channel] = (min(low, note), max(high, note))
+                else:
+                    released.add((channel, note))
+            held = sounding.setdefault(channel, {})
+            if channel not in self.stats:
+                self.stats[channel] = ChannelStats(channel)
+            stats = self.stats[channel]
+            if velocity:
+                held[note] = held.get(note, 0) + 1
+                stats.notes += 1
+                stats.lowest = note if stats.lowest is None else min(stats.lowest, note)
+                stats.highest = note if stats.highest is None else max(stats.highest, note)
+                stats.max_polyphony = max(stats.max_polyphony, len(held))
+            elif note in held:
+                held[note] -= 1
+                if not held[note]:
+                    del held[note]
+            if not held:
+                del sounding[channel]
+        # each state as (seconds, {channel: notes sounding}), for the channels a drive could play
+        self.channels = sorted(c for c, s in self.stats.items() if s.notes and c != PERCUSSION_CHANNEL)
+        self.states = [(seconds, {c: n for c, n in state if c != PERCUSSION_CHANNEL})
+                       for state, seconds in states.items()]
+
+    def note_seconds(self):
+        return sum(self.stats[c].note_seconds for c in self.channels)
+
+# the search over one analysis. A drive is (channel, fallback channel or 0), where a
+# negative channel takes the lowest note. Each group is kept as its seconds, the most
+# drives that count in it, and the candidates (as indexes) that belong to it
+class Search:
+    def __init__(self, analysis, drives, spread=False):
+        self.drives = drives
+        self.channels = analysis.channels
+        self.candidates = [(sign * c, fallback) for c in self.channels for sign in (1, -1)
+                           for fallback in [0] + [f for f in self.channels if f != c]]
+        self.index = {drive: i for i, drive in enumerate(self.candidates)}
+        groups = self._spread_groups(analysis) if spread else self._follow_groups(analysis)
+        self.seconds = [seconds for seconds, _, _ in groups]
+        self.caps = [cap for _, cap, _ in groups]
+        self.members = [members for _, _, members in groups]
+        self.groups_of = [[] for _ in self.candidates]
+        for g, members in enumerate(self.members):
+            for i in members:
+                self.groups_of[i].append(g)
+        # measured against all of the song's notes, so coverage with and without spread compare
+        self.total = analysis.note_seconds()
+        self.reset()
+
+    # candidates by channel, as (taking its highest notes first, taking its lowest
+    # notes first, falling back to it)
+    def _by_channel(self):
+        highest = {c: [] for c in self.channels}
+        lowest = {c: [] for c in self.channels}
+        fallback = {c: [] for c in self.channels}
+        for i, (c, f) in enumerate(self.candidates):
+            (highest if c > 0 else lowest)[abs(c)].append(i)
+            if f:
+                fallback[f].append(i)
+        return highest, lowest, fallback
+
+    # with spread, a group for each channel sounding in each state, shared by the drives
+    # that take their notes from it there: those on the channel, and those falling back
+    # to it while their own channel is silent
+    def _spread_groups(self, analysis):
+        merged = {}
+        for seconds, notes in analysis.states:
+            # no channel can use more drives than it ever has notes
+            key = tuple(sorted((c, min(n, self.drives)) for c, n in notes.items() if n))
+            if key:
+                merged[key] = merged.get(key, 0.0) + seconds
+        highest, lowest, fallback = self._by_channel()
+        groups = []
+        for key, seconds in merged.items():
+            notes = dict(key)
+            for c, n in key:
+                members = highest[c] + lowest[c] + [i for i in fallback[c] if abs(self.candidates[i][0]) not in notes]
+                groups.append((seconds, n, members))
+        return groups
+
+    # without spread, follows every candidate drive through the song as the encoder
+    # does, and makes a group of each set of candidates playing the same note, for as
+    # long as they all play it
+    def _follow_groups(self, analysis):
+        highest, lowest, fallback = self._by_channel()
+        own = [abs(c) for c, _ in self.candidates]
+        playing = [None] * len(self.candidates)
+        spans = {}      # (channel, note) -> [candidates playing it, since when]
+        merged = {}     # candidates -> seconds they spent playing the same note
+        for now, starts, released in analysis.events:
+            picks = {}
+            for c, (low, high) in starts.items():
+                picks.update(dict.fromkeys(highest[c], (c, high)))
+                picks.update(dict.fromkeys(lowest[c], (c, low)))
+                picks.update(dict.fromkeys([i for i in fallback[c] if own[i] not in starts], (c, high)))
+            for note in released:
+                if note in spans:
+                    for i in spans[note][0]:
+                        picks.setdefault(i, None)
+            # candidates changing notes together are moved together
+            moves = {}
+            for i, note in picks.items():
+                if note != playing[i]:
+                    moves.setdefault((playing[i], note), []).append(i)
+                    playing[i] = note
+            for (old, note), movers in moves.items():
+                # a span ends whenever the candidates playing its note change
+                for n in (old, note):
+                    if n in spans:
+                        self._close_span(spans[n], now, merged)
+                if old is not None:
+                    members = spans[old][0]
+                    members.difference_update(movers)
+                    if not members:
+                        del spans[old]
+                if note is not None:
+                    if note not in spans:
+                        spans[note] = [set(), now]
+                    spans[note][0].update(movers)
+        # anything still playing at the end plays until the song's length
+        for span in spans.values():
+            self._close_span(span, analysis.length, merged)
+        return [(seconds, 1, list(members)) for members, seconds in merged.items()]
+
+    # adds the time since a span last changed to the seconds its candidates spent together
+    @staticmethod
+    def _close_span(span, now, merged):
+        members, since = span
+        if now > since:
+            key = frozenset(members)
+            merged[key] = merged.get(key, 0.0) + now - since
+            span[1] = now
+
+    def reset(self):
+        self.counts = [0] * len(self.caps)
+        # how much each candidate drive would add to the note time covered
+        self.gains = [sum(self.seconds[g] for g in groups) for groups in self.groups_of]
+        self.covered = 0.0
+        self.orchestration = []
+
+    # the drive that would add the most, as (gain, drive)
+    def best_candidate(self):
+        # ties go to the simplest drive: no fallback, then the lowest channel, highest note first
+        drive = max(self.candidates, key=lambda d: (round(self.gains[self.index[d]], 9), not d[1],
+                                                    -abs(d[0]), d[0] > 0, -d[1]))
+        return self.gains[self.index[drive]], drive
+
+    # a group stops adding anything once it has as many drives as it counts; only then,
+    # or when it drops below that again, do its members' gains change
+    def add(self, drive, sign=1):
+        for g in self.groups_of[self.index[drive]]:
+            seconds = self.seconds[g]
+            cap = self.caps[g]
+            if sign > 0:
+                if self.counts[g] < cap:
+                    self.covered += seconds
+                self.counts[g] += 1
+                if self.counts[g] == cap:
+                    for i in self.members[g]:
+                        self.gains[i] -= seconds
+            else:
+                if self.counts[g] == cap:
+                    for i in self.members[g]:
+                        self.gains[i] += seconds
+                self.counts[g] -= 1
+                if self.counts[g] < cap:
+                    self.covered -= seconds
+        if sign > 0:
+            self.orchestration.append(drive)
+        else:
+            self.orchestration.remove(drive)
+
+    # fills the drives one at a time with whichever adds the most, then keeps taking
+    # each drive out and putting back the best replacement until nothing improves.
+    # Drives stop being added once another would play nothing more, so the
+    # orchestration can come out with fewer than self.drives of them.
+    def run(self):
+        self.reset()
+        if not self.channels:
+            return
+        while len(self.orchestration) < self.drives:
+            gain, drive = self.best_candidate()
+            if gain <= 1e-9:
+                break
+            self.add(drive)
+        for _ in range(MAX_PASSES):
+            improved = False
+            for i in range(len(self.orchestration)):
+                drive = self.orchestration[i]
+                before = self.covered
+                self.add(drive, -1)
+                _, replacement = self.best_candidate()
+                self.add(replacement)
+                if self.covered > before + 1e-9:
+                    improved = True
+                else:
+                    self.add(replacement, -1)
+                    self.add(drive)
+                # keep the drive in its place, so passes visit each slot once
+                self.orchestration.insert(i, self.orchestration.pop())
+            if not improved:
+                break
+
+    def coverage(self):
+        return self.covered / self.total if self.total else 0.0
+
+# the best orchestration found for up to `drives` drives, as (coverage, orchestration),
+# where coverage is the fraction of the song's note time the drives play and each drive
+# is a list of channels, as parse_orchestration() returns them; there are fewer drives
+# than asked for when the rest would have nothing to play
+def suggest(analysis, drives, spread=False):
+    search = Search(analysis, drives, spread)
+    search.run()
+    orchestration = sorted(search.orchestration, key=lambda d: (abs(d[0]), d[0] < 0, d[1]))
+    return search.coverage(), [[c, f] if f else [c] for c, f in orchestration]
+
+# analyses a MIDI file and suggests an orchestration for it, as (analysis, coverage, orchestration)
+def suggest_file(infile, drives, spread=False):
+    with open(infile, 'rb') as f:
+        analysis = Analysis(f.read())
+    return (analysis,) + suggest(analysis, drives, spread)
+
+# the orchestration as convert_midi.py's arguments
+def format_orchestration(orchestration):
+    return ' '.join(','.join(str(c) for c in drive) for drive in orchestration)
@@ -0,0 +1,263 @@
+# Plays one song across several Picos, each driving its own range of drives.
+# The encoded stream is split into a stream per board, each just as a single board
+# would be sent it, with a sync word at the same points in the song in every one.
+# Every board is held until they all have the start of their streams, and then
+# started at once. Each board reports as it plays a sync word; the host compares when
+# the reports arrive and nudges any board that has drifted away from the others back
+# into line (see play_stream() in firmware/music_player.py).
+import queue
+import statistics
+import sys
+import threading
+import time
+from pico_connection import PicoConnection, SYNC_WORD
+
+# a sync word goes into the streams at least this often (in song time)
+SYNC_INTERVAL_MS = 2000
+# boards this close to the others are left alone
+SYNC_TOLERANCE_MS = 2
+# how far the splitter may run ahead of the slowest board
+QUEUE_WORDS = 4096
+# each board has at most 12 drives, so its stream never needs protocol 2
+MAX_BOARD_DRIVES = 12
+# how long a board's sender waits for the splitter before checking on its board:
+# a sync report is only timed when it is read, so this must be well inside
+# SYNC_TOLERANCE_MS
+IDLE_POLL_S = 0.0005
+
+# share num_drives out between boards as evenly as possible, in order
+def split_drives(num_drives, boards):
+    base, extra = divmod(num_drives, boards)
+    return [base + 1 if b < extra else base for b in range(boards)]
+
+def parse_board_drives(spec):
+    try:
+        return [int(n) for n in spec.split(',')]
+    except ValueError:
+        raise ValueError(f'invalid drive counts: {spec}')
+
+# yields (board, word) for each word of each board's stream. Board b plays
+# drive_counts[b] voices, starting from the first voice after the previous board's;
+# voices are renumbered from 0 on each board. Delays are held back from a board
+# until it has something else to play, so consecutive delays merge.
+def split_stream(words, drive_counts, sync_interval_ms=SYNC_INTERVAL_MS):
+    voices = [(board, voice) for board, count in enumerate(drive_counts) for voice in range(count)]
+    boards = range(len(drive_counts))
+    pending_ms = [0] * len(drive_counts)
+    song_ms = 0
+    next_sync_ms = 0
+    sync_seq = 0
+    voice_shift = 11
+    freq_mask = 0x7FF
+    table_words = 0
+
+    def flush_delay(board):
+        ms = pending_ms[board]
+        pending_ms[board] = 0
+        while ms > 0x3FFF:
+            yield board, 0xBFFF
+            ms -= 0x3FFF
+        if ms > 0:
+            yield board, 0x8000 | ms
+
+    def to_all(word):
+        for board in boards:
+            yield from flush_delay(board)
+            yield board, word
+
+    def notes_off(mask, first_voice):
+        masks = [0] * len(drive_counts)
+        voice = first_voice
+        while mask:
+            if mask & 1:
+                board, local = voices[voice]
+                masks[board] |= 1 << local
+            mask >>= 1
+            voice += 1
+        for board in boards:
+            if masks[board]:
+                yield from flush_delay(board)
+                yield board, 0xC000 | masks[board]
+
+    for word in words:
+        if table_words:
+            # the divider table is the same for every board
+            table_words -= 1
+            for board in boards:
+                yield board, word
+            continue
+        if word & 0xc000 == 0x8000:
+            ms = word & 0x3FFF
+            song_ms += ms
+            for board in boards:
+                pending_ms[board] += ms
+            continue
+        if song_ms >= next_sync_ms:
+            yield from to_all(SYNC_WORD | (sync_seq & 0xFF))
+            sync_seq += 1
+            next_sync_ms = song_ms + sync_interval_ms
+        if word & 0x8000 == 0:
+            board, local = voices[word >> voice_shift]
+            yield from flush_delay(board)
+            yield board, (local << 11) | (word & freq_mask)
+        elif word & 0xf000 == 0xc000:
+            yield from notes_off(word & 0xFFF, 0)
+        elif word & 0xe000 == 0xe000 and word & 0x0c00 != 0x0c00:
+            yield from notes_off(word & 0x3FF, 12 + ((word >> 10) & 3) * 10)
+        elif word & 0xf800 == 0xd000:
+            table_words = (word & 0x7FF) * 2
+            yield from to_all(word)
+        elif word & 0xff00 == 0xdf00:
+            # each board's stream is protocol 1, so the header isn't passed on
+            revision = word & 0xFF
+            if revision == 1:
+                voice_shift, freq_mask = 11, 0x7FF
+            elif revision == 2:
+                voice_shift, freq_mask = 10, 0x3FF
+            else:
+                raise ValueError(f'unsupported protocol revision {revision}')
+        else:
+            yield from to_all(word)
+    for board in boards:
+        yield from flush_delay(board)
+
+class Board:
+    def __init__(self, connection, drives):
+        self.connection = connection
+        self.drives = drives
+        self.queue = queue.Queue(QUEUE_WORDS)
+        self.reports = []           # when each sync word was reported played
+        self.error = None
+
+class PicoCluster:
+    def __init__(self, devices=None):
+        devices = devices or PicoConnection.find_pico_ports()
+        if not devices:
+            raise RuntimeError("Pico not found")
+        self.connections = [PicoConnection(device) for device in devices]
+        self.lock = threading.Lock()
+        self.stopping = False
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+    # drive_counts gives the number of drives on each board, in order;
+    # returns False if the song was stopped with Ctrl+C
+    def play_song(self, words, drive_counts):
+        if len(drive_counts) != len(self.connections):
+            raise ValueError(f'{len(drive_counts)} drive counts given for {len(self.connections)} boards')
+        if max(drive_counts) > MAX_BOARD_DRIVES:
+            raise ValueError(f'a board can have at most {MAX_BOARD_DRIVES} drives')
+        self.boards = [Board(c, n) for c, n in zip(self.connections, drive_counts)]
+        self.stopping = False
+        self.error = None
+        self.nudges = 0
+        self.worst_skew_ms = 0
+        for board in self.boards:
+            # homing a board's drives once the others are waiting for it could hold them
+            # past the time they wait for a stream before giving up, so it is done first
+            if board.connection.session_drives < board.drives:
+                board.connection.open_session(board.drives)
+        self.barrier = threading.Barrier(len(self.boards), action=self._start_boards)
+        threads = [threading.Thread(target=self._run_board, args=(board,)) for board in self.boards]
+        threads.append(threading.Thread(target=self._run_splitter, args=(words, drive_counts)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                try:
+                    thread.join(0.1)
+                except KeyboardInterrupt:
+                    self._stop()
+        self.report()
+        for error in [self.error] + [board.error for board in self.boards]:
+            if error:
+                raise error
+        return not self.stopping
+
+    def report(self):
+        syncs = min((len(board.reports) for board in self.boards), default=0)
+        print('cluster: {} sync points, worst skew {:.1f} ms, {} nudge(s)'.format(
+            syncs, self.worst_skew_ms, self.nudges), file=sys.stderr)
+
+    def _stop(self):
+        self.stopping = True
+        self.barrier.abort()
+        for board in self.boards:
+            # boards still being sent words stop when they next take one
+            if board.connection.draining:
+                board.connection.abort()
+
+    def _run_board(self, board):
+        try:
+            board.connection.play_song(self._board_words(board), drives=board.drives,
+                                       on_held=self._held, on_sync=lambda: self._on_sync(board))
+        except Exception as e:
+            board.error = e
+            self._stop()
+
+    # called on each board's thread once the board has its first chunks; the last one
+    # there starts every board, one straight after another
+    def _held(self):
+        try:
+            self.barrier.wait()
+        except threading.BrokenBarrierError:
+            # stopped before every board was ready
+            raise KeyboardInterrupt
+
+    def _start_boards(self):
+        for board in self.boards:
+            board.connection.start()
+
+    def _run_splitter(self, words, drive_counts):
+        try:
+            for board, word in split_stream(words, drive_counts):
+                self._put(self.boards[board], word)
+        except Exception as e:
+            self.error = e
+            self._stop()
+        finally:
+            for board in self.boards:
+                self._put(board, None)
+
+    def _put(self, board, word):
+        while not self.stopping:
+            try:
+                board.queue.put(word, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    # a board's words, with None whenever the splitter is busy with the other boards
+    # (a board playing a sparse part can have nothing new for a long time)
+    def _board_words(self, board):
+        while True:
+            if self.stopping:
+                raise KeyboardInterrupt
+            try:
+                word = board.queue.get(timeout=IDLE_POLL_S)
+            except queue.Empty:
+                yield None
+                continue
+            if word is None:
+                return
+            yield word
+
+    # called on a board's thread as it reports each sync word; once every board
+    # has reported the same one, any that are out of line are nudged
+    def _on_sync(self, board):
+        now = time.monotonic()
+        with self.lock:
+            seq = len(board.reports)
+            board.reports.append(now)
+            if any(len(b.reports) <= seq for b in self.boards):
+                return
+            arrivals = [b.reports[seq] for b in self.boards]
+            self.worst_skew_ms = max(self.worst_skew_ms, (max(arrivals) - min(arrivals)) * 1000)
+        reference = statistics.median(arrivals)
+        for b, arrival in zip(self.boards, arrivals):
+            late_ms = round((arrival - reference) * 1000)
+            if abs(late_ms) > SYNC_TOLERANCE_MS:
+                b.connection.nudge(-late_ms)
+                self.nudges += 1
@@ -1,14 +1,324 @@
+from array import array
+from collections import deque
+import asyncio
+import threading
 import serial
 from serial.tools import list_ports
-from pyboard import Pyboard
+import sys
+import time
+from pyboard import Pyboard, PyboardError
+from async_pyboard import AsyncPyboard
+
+# these must match the stream protocol constants in firmware/music_player.py
+STREAM_CHUNK = 128
+STREAM_CHUNKS = 8
+STREAM_CREDIT = b'\x01'
+STREAM_SYNC = b'\x02'
+END_OF_STREAM = 0xFFFF
+ABORT_STREAM = 0xFFFE
+SYNC_WORD = 0xDC00
+NUDGE_WORD = 0xDD00
+START_WORD = 0xDB00
+
+# the firmware sets up this many drives unless asked for more (Sound.DRIVES)
+DEFAULT_DRIVES = 4
+
+# MicroPython's ticks_us() wraps at 2**30
+TICKS_MAX = (1 << 30) - 1
+TICKS_HALFPERIOD = 1 << 29
+
+# a zero-length delay; pads out a chunk that has to be sent before it is full
+STREAM_NOP = 0x8000
+# a player with nothing to play is sent a chunk of NOPs this often, well inside the
+# STREAM_TIMEOUT_MS (2000) after which it gives up on the host
+STREAM_KEEPALIVE_MS = 500
+
+# run when a session starts: prints how many drives the player left on the Pico by an
+# earlier session has (0 if there isn't one), and switches off its jitter log
+SESSION_PROBE = "try:\r\n m.instrument(0)\r\n print(m.sound.drives)\r\nexcept NameError:\r\n print(0)\r\n"
+
+# sends a word stream to MusicPlayer.play_stream() as raw big-endian words,
+# never putting more chunks in flight than the player has room for.
+# It also keeps track of the song time covered by what has been sent and by what
+# the player has acknowledged, so it knows how much playback is buffered on the
+# device: when that runs low, chunks go out as soon as possible (even partially
+# filled), otherwise they are batched into writes sized by the measured throughput.
+# The words may include None wherever the next word isn't ready yet (see _chunks()).
+class StreamSender:
+    SAFETY_MARGIN_MS = 250
+    # a batched write should take no more than this fraction of the buffered time
+    BATCH_TIME_FRACTION = 0.1
+
+    # on_sync, if given, is called as each sync word is reported played; on_held, if
+    # given, is called once the first chunks have gone to a player that is being held
+    # (see PicoConnection.play_song()), and playback is taken to start when it returns
+    def __init__(self, serial, verbose=True, on_sync=None, on_held=None):
+        self.serial = serial
+        self.verbose = verbose
+        self.on_sync = on_sync
+        self.on_held = on_held
+        # out-of-band chunks may be sent from other threads, but never in the middle of a batch
+        self.write_lock = threading.Lock()
+        self.credits = STREAM_CHUNKS
+        self.song_ms = 0            # song time at the end of the words taken so far
+        self.chunk_ms = 0           # song time when the player reads the last word taken
+        self.in_flight = deque()    # chunk_ms of the last word of each unacknowledged chunk
+        self.sent_ms = 0            # song time at the end of everything sent
+        self.played_ms = 0          # song time when the player acknowledged its last chunk...
+        self.played_at = None       # ...and when that happened by our clock
+        self.sent_at = None         # when the last chunk was written
+        self.idle = False           # the words have nothing ready, so pending chunks go now
+        self.bytes_per_sec = None
+        self.low_buffer = False
+        self.low_buffer_events = 0
+        self.min_buffered_ms = None
+
+    def send(self, words):
+        pending = []
+        for chunk in self._chunks(words):
+            pending.append(chunk)
+            self._send_pending(pending)
+        self._send_pending(pending, final=True)
+
+    # stop playback right away, even if the player's buffer is full
+    def abort(self):
+        with self.write_lock:
+            self.serial.write(self._pad(bytearray(), ABORT_STREAM))
+
+    # start a player that is being held; safe to call from another thread
+    def start(self):
+        with self.write_lock:
+            self.serial.write(self._pad(bytearray(), START_WORD))
+
+    # move the rest of the song later by ms milliseconds (earlier, if negative) as
+    # soon as the player receives this; safe to call from another thread
+    def nudge(self, ms):
+        while ms:
+            step = max(-127, min(127, ms))
+            with self.write_lock:
+                self.serial.write(self._pad(bytearray(), NUDGE_WORD | (step & 0xFF)))
+            ms -= step
+
+    # once everything has been sent, keep taking credits and sync reports until
+    # play_stream() returns and the raw REPL marks the end of its output
+    def drain(self):
+        while self._drained(self.serial.read(1)):
+            pass
+
+    # how much song time the player has buffered, by our best estimate
+    def buffered_ms(self):
+        if self.played_at is None:
+            return self.sent_ms
+        return self.sent_ms - self.played_ms - (time.monotonic() - self.played_at) * 1000
+
+    def report(self):
+        if self.min_buffered_ms is None:
+            return
+        throughput = '{:.0f} bytes/s'.format(self.bytes_per_sec) if self.bytes_per_sec else 'unknown'
+        print('stream: lowest buffer {:.0f} ms, {} time(s) below {} ms, throughput {}'.format(
+            self.min_buffered_ms, self.low_buffer_events, self.SAFETY_MARGIN_MS, throughput), file=sys.stderr)
+
+    def _pad(self, chunk, word):
+        return chunk + word.to_bytes(2, byteorder='big') * ((STREAM_CHUNK - len(chunk)) // 2)
+
+    def _batch_size(self):
+        if self.played_at is None:
+            # fill the player's whole buffer in one go before it starts playing
+            return STREAM_CHUNKS
+        if not self.bytes_per_sec:
+            return 1
+        batch_bytes = self.bytes_per_sec * max(self.buffered_ms(), 0) / 1000 * self.BATCH_TIME_FRACTION
+        return max(1, min(STREAM_CHUNKS, int(batch_bytes // STREAM_CHUNK)))
+
+    # yields (chunk, read_ms, end_ms) for each chunk of the stream: the song times at
+    # which the player reads its last word and finishes it. A chunk is yielded once
+    # full, or sooner if the player is running low; the last is padded to the end.
+    # A None in words means nothing more is ready yet: see _idle_chunk_due().
+    def _chunks(self, words):
+        chunk = bytearray()
+        for word in words:
+            if word is None:
+                self._poll_credits()
+                if self._idle_chunk_due(chunk):
+                    self.idle = True
+                    yield self._pad(chunk, STREAM_NOP), self.chunk_ms, self.song_ms
+                    self.idle = False
+                    chunk = bytearray()
+                continue
+            self.chunk_ms = self.song_ms
+            if word & 0xc000 == 0x8000:
+                self.song_ms += word & 0x3FFF
+            chunk += word.to_bytes(2, byteorder='big')
+            if len(chunk) == STREAM_CHUNK:
+                yield chunk, self.chunk_ms, self.song_ms
+                chunk = bytearray()
+            elif self.played_at is not None and self.credits and self.buffered_ms() < self.SAFETY_MARGIN_MS:
+                # the encoder isn't keeping up; don't wait for this chunk to fill
+                yield self._pad(chunk, STREAM_NOP), self.chunk_ms, self.song_ms
+                chunk = bytearray()
+        yield self._pad(chunk, END_OF_STREAM), self.chunk_ms, self.song_ms
+
+    # whether to send what there is of the current chunk, padded with NOPs, while waiting
+    # for more words: the first chunk straight away, so that a sparse stream starts
+    # when it should, and after that whenever the player is running low, with an empty
+    # chunk now and then so that a player with nothing to play doesn't give up on us
+    def _idle_chunk_due(self, chunk):
+        if not self.credits:
+            return False
+        if self.played_at is None:
+            return bool(chunk)
+        if self.buffered_ms() >= self.SAFETY_MARGIN_MS:
+            return False
+        return bool(chunk) or (time.monotonic() - self.sent_at) * 1000 >= STREAM_KEEPALIVE_MS
+
+    def _send_pending(self, pending, final=False):
+        self._poll_credits()
+        while self._ready_to_send(pending, final):
+            while self.credits == 0:
+                self._receive_credit()
+            batch, data = self._take_batch(pending)
+            start = time.monotonic()
+            with self.write_lock:
+                self.serial.write(data)
+            self._batch_sent(batch, len(data), start)
+            self._poll_credits()
+
+    def _ready_to_send(self, pending, final):
+        return pending and (final or self.idle or len(pending) >= self._batch_size() or self._check_buffer())
+
+    # as many pending chunks as the player has room for, and their bytes
+    def _take_batch(self, pending):
+        batch = pending[:self.credits]
+        del pending[:len(batch)]
+        return batch, b''.join(chunk for chunk, _, _ in batch)
+
+    def _batch_sent(self, batch, size, start):
+        self.sent_at = time.monotonic()
+        self._measure_throughput(size, self.sent_at - start)
+        first = self.played_at is None
+        if first:
+            # playback starts as soon as the first chunk arrives, unless the player is held
+            self.played_at = start
+        for _, read_ms, end_ms in batch:
+            self.in_flight.append(read_ms)
+            self.sent_ms = end_ms
+        self.credits -= len(batch)
+        if first and self.on_held:
+            self.on_held()
+            self.played_at = time.monotonic()
+
+    # true (and logged) if the player is running low on buffered song time
+    def _check_buffer(self):
+        if self.played_at is None:
+            return False
+        buffered = self.buffered_ms()
+        if self.min_buffered_ms is None or buffered < self.min_buffered_ms:
+            self.min_buffered_ms = buffered
+        low = buffered < self.SAFETY_MARGIN_MS
+        if low and not self.low_buffer:
+            self.low_buffer_events += 1
+            if self.verbose:
+                print('stream: only {:.0f} ms buffered at {:.3f} s'.format(buffered, self.played_ms / 1000), file=sys.stderr)
+        self.low_buffer = low
+        return low
+
+    def _measure_throughput(self, size, elapsed):
+        if elapsed <= 0:
+            return
+        rate = size / elapsed
+        self.bytes_per_sec = rate if self.bytes_per_sec is None else 0.8 * self.bytes_per_sec + 0.2 * rate
+
+    def _poll_credits(self):
+        while self.serial.inWaiting() > 0:
+            self._receive_credit()
+
+    def _receive_credit(self):
+        self._received(self.serial.read(1))
+
+    # whatever the serial port has buffered
+    def _waiting(self):
+        return self.serial.read(self.serial.inWaiting())
+
+    def _received(self, data):
+        if data == STREAM_SYNC:
+            if self.on_sync:
+                self.on_sync()
+            return
+        if data != STREAM_CREDIT:
+            # anything else means play_stream() has failed and the REPL is reporting why
+            raise PyboardError('unexpected data from player: {!r}'.format(data + self._waiting()))
+        self.credits += 1
+        self.played_ms = self.in_flight.popleft()
+        self.played_at = time.monotonic()
+        self._check_buffer()
+
+    # handles a byte received while draining; false once it's the end of play_stream()'s output
+    def _drained(self, data):
+        if data == b'\x04':
+            return False
+        if data == STREAM_SYNC:
+            if self.on_sync:
+                self.on_sync()
+        elif data == STREAM_CREDIT and self.in_flight:
+            self.credits += 1
+            self.played_ms = self.in_flight.popleft()
+            self.played_at = time.monotonic()
+        elif data != STREAM_CREDIT:
+            raise PyboardError('unexpected data from player: {!r}'.format(data + self._waiting()))
+        return True
+
+# a StreamSender for an AsyncPyboard: waiting for credits yields to the event loop
+# rather than blocking, so one thread can stream to several Picos at once
+class AsyncStreamSender(StreamSender):
+    def __init__(self, board, verbose=True, on_sync=None):
+        super().__init__(board.serial, verbose, on_sync)
+        self.board = board
+
+    async def send(self, words):
+        pending = []
+        for chunk in self._chunks(words):
+            pending.append(chunk)
+            await self._send_pending(pending)
+        await self._send_pending(pending, final=True)
+
+    async def drain(self):
+        while self._drained(await self.board.read(1, timeout=None)):
+            pass
+
+    async def _send_pending(self, pending, final=False):
+        self._poll_credits()
+        while self._ready_to_send(pending, final):
+            while self.credits == 0:
+                self._received(await self.board.read(1, timeout=None))
+            batch, data = self._take_batch(pending)
+            start = time.monotonic()
+            with self.write_lock:
+                self.board.write(data)
+            self._batch_sent(batch, len(data), start)
+            self._poll_credits()
+
+    def _poll_credits(self):
+        while self.board.in_waiting():
+            self._received(self.board.read_waiting(1))
+
+    def _waiting(self):
+        return self.board.read_waiting()
 
 class PicoConnection:
-    def __init__(self):
+    # device may name a serial port (or anything else Pyboard accepts, such as
+    # a pty from util/fake_pico.py); by default the first Pico found is used
+    def __init__(self, device=None):
         self.pyboard = None # to prevent another exception in the destructor if initialization fails
-        self.pyboard = Pyboard(self._find_pico_port())
+        self.draining = False # every word has been sent, and the Pico is playing out what it has
+        self.sender = None
+        self.session_drives = 0 # drives of the player kept on the Pico between songs, once there is one
+        self.jitter_log = 0
+        self.playlist_playing = False # play_playlist() is taking commands
+        self.pyboard = Pyboard(device or self._find_pico_port())
 
     # borrowed from https://github.com/dhylands/rshell/blob/master/rshell/main.py
-    def _is_pico_usb_device(self, port):
+    @staticmethod
+    def _is_pico_usb_device(port):
         if type(port).__name__ == 'Device':
             # Assume its a pyudev.device.Device
             if ('ID_BUS' not in port or port['ID_BUS'] != 'usb' or
@@ -27,38 +337,317 @@ class PicoConnection:
         return False
 
     def _find_pico_port(self):
-        for port in serial.tools.list_ports.comports():
-            if self._is_pico_usb_device(port):
-                return port.device
-        raise RuntimeError("Pico not found")
+        ports = self.find_pico_ports()
+        if not ports:
+            raise RuntimeError("Pico not found")
+        return ports[0]
 
-    def _send_command_queue(self, commands):
-        print(commands)
-        self.pyboard.exec(f't=m.play_words({commands},t)\r\n')
+    # every Pico connected, for playing a song across several of them
+    @classmethod
+    def find_pico_ports(cls):
+        return [port.device for port in serial.tools.list_ports.comports()
+                if cls._is_pico_usb_device(port)]
 
-    def play_song(self, buf):
-        try:
-            self.pyboard.enter_raw_repl()
-            self.pyboard.exec("import utime\r\n")
+    # gets the Pico ready to play songs on up to `drives` drives: a MusicPlayer `m` that
+    # stays in the raw REPL between songs, so the next one can start straight away.
+    # A player left by an earlier connection is picked up again (it lasts until the
+    # Pico is reset) unless fresh is true, which soft-resets the Pico first. Creating
+    # a player re-homes every drive, so that only happens when there isn't one with
+    # enough drives. Returns (step, seconds) for each step taken, as it reports them.
+    def open_session(self, drives=DEFAULT_DRIVES, fresh=False):
+        drives = max(drives, DEFAULT_DRIVES)
+        timings = []
+        start = time.monotonic()
+        self._enter_raw_repl(soft_reset=fresh)
+        self.session_drives = int(self.pyboard.exec(SESSION_PROBE))
+        self.jitter_log = 0
+        timings.append(('raw REPL', time.monotonic() - start))
+        if self.session_drives < drives:
+            start = time.monotonic()
             self.pyboard.exec("from music_player import MusicPlayer\r\n")
-            self.pyboard.exec("m=MusicPlayer()\r\n")
-            self.pyboard.exec("t=utime.ticks_ms()\r\n")
-            bytes = buf.read(2)
-            command_queue = []
-            while bytes:
-                cmd = int.from_bytes(bytes, byteorder='big')
-                # wait until a suitably long delay to send a command string,
-                # (or if the queue grows too long, send it anyway and risk an audible hiccup)
-                if len(command_queue) > 100 or ((cmd & 0xc000) == 0x8000 and (cmd & 0x3fff) > 100):
-                    self._send_command_queue(command_queue)
-                    command_queue.clear()
-                command_queue.append(cmd)
-                bytes = buf.read(2)
-            # send remaining commands followed by a one-second delay so notes can fade
-            command_queue.append(0x83e8)
-            self._send_command_queue(command_queue)
+            homing_ms = int(self.pyboard.exec(f"m=MusicPlayer(drives={drives})\r\nprint(m.sound.homing_ms)\r\n"))
+            self.session_drives = drives
+            timings.append((f'new {drives}-drive player (homing {homing_ms} ms)', time.monotonic() - start))
+        _report_session(timings, self.session_drives)
+        return timings
+
+    # words is any iterable of encoded 16-bit words; it is consumed lazily
+    # so a generator can feed the Pico while it is still being encoded, and may
+    # yield None while it has nothing ready, to let what it has so far be sent.
+    # If jitter_log is nonzero, the Pico records how late each of the last
+    # jitter_log words was played, for fetch_jitter() to collect afterwards.
+    # ready, if given, is called once the Pico is waiting for the stream, and
+    # on_sync as it reports each sync word played (see StreamSender). If on_held is
+    # given, the Pico is held: it takes the first chunks of the stream but waits for
+    # start() before playing them, and on_held is called once they have been sent.
+    # Returns False if the song was stopped with Ctrl+C.
+    def play_song(self, words, jitter_log=0, drives=DEFAULT_DRIVES, ready=None, on_sync=None, on_held=None):
+        sender = self.sender = StreamSender(self.pyboard.serial, on_sync=on_sync, on_held=on_held)
+        try:
+            if self.session_drives < drives:
+                self.open_session(drives)
+            if jitter_log != self.jitter_log:
+                self.pyboard.exec(f"m.instrument({jitter_log})\r\n")
+                self.jitter_log = jitter_log
+            self.pyboard.exec_raw_no_follow(f"m.play_stream({on_held is not None})\r\n")
+            if ready:
+                ready()
+            sender.send(_with_fade(words))
+            self.draining = True
+            sender.drain()
+            # what's left is the end of the raw REPL's response: any error, then another Ctrl-D
+            err = self.pyboard.read_until(1, b'\x04', timeout=None)[:-1]
+            if err:
+                raise PyboardError('exception', b'', err)
         except KeyboardInterrupt:
-            # force a Ctrl+C to be sent to the Pico
-            self.pyboard.enter_raw_repl()
+            # the player ignores Ctrl+C while streaming, so ask it to stop
+            sender.abort()
+            self.pyboard.follow(timeout=None)
+            return False
         finally:
-            self.pyboard.exit_raw_repl()
+            self.draining = False
+            self.sender = None
+            sender.report()
+        return True
+
+    # plays songs already on the Pico's file system (see util/pico_files.py) one after
+    # another with no gap between them; queue_song(), skip_song() and stop_playlist()
+    # may be called from another thread while it plays. on_song, if given, is called
+    # with each path as the Pico starts playing it.
+    # Returns False if the playlist was stopped with Ctrl+C.
+    def play_playlist(self, paths, drives=DEFAULT_DRIVES, on_song=None):
+        if self.session_drives < drives:
+            self.open_session(drives)
+        self.pyboard.exec_raw_no_follow(f"m.play_playlist({list(paths)!r})\r\n")
+        self.playlist_playing = True
+        try:
+            stopped = self._follow_playlist(on_song)
+        finally:
+            self.playlist_playing = False
+        out, err = self.pyboard.follow(timeout=None)
+        if err:
+            raise PyboardError('exception', out, err)
+        return not stopped
+
+    # each of these returns False if no playlist was playing to take the command
+    def queue_song(self, path):
+        return self._playlist_command(f'queue {path}')
+
+    def skip_song(self):
+        return self._playlist_command('skip')
+
+    def stop_playlist(self):
+        return self._playlist_command('stop')
+
+    # the Pico's output while it plays a playlist, up to its last line; returns
+    # True if it was stopped with Ctrl+C
+    def _follow_playlist(self, on_song):
+        stopped = False
+        while True:
+            try:
+                line = self.pyboard.read_until(1, b'\n', timeout=None)
+            except KeyboardInterrupt:
+                # let the Pico finish cleanly, so the session can carry on
+                self.stop_playlist()
+                stopped = True
+                continue
+            if line.startswith(b'\x04'):
+                # the player has failed, and this is the end of its output
+                err = line[1:] + self.pyboard.read_until(1, b'\x04', timeout=None)
+                raise PyboardError('exception', b'', err[:-1])
+            line = line.decode(errors='replace').strip()
+            if line == 'done':
+                # anything sent from now on would be taken for the next REPL command
+                self.playlist_playing = False
+                return stopped
+            if line.startswith('playing '):
+                if on_song:
+                    on_song(line[len('playing '):])
+            elif line:
+                print(line, file=sys.stderr)
+
+    def _playlist_command(self, command):
+        if '\n' in command:
+            raise ValueError(f'invalid playlist command: {command!r}')
+        if not self.playlist_playing:
+            return False
+        self.pyboard.serial.write(command.encode() + b'\n')
+        return True
+
+    # stop the song play_song() is playing, from another thread, by sending the player an
+    # abort chunk. This only happens once play_song() is draining: until then it is still
+    # sending words, which would reach the REPL once the player had stopped. To stop it
+    # sooner, have the words it is taking raise KeyboardInterrupt (as PicoCluster does).
+    def abort(self):
+        sender = self.sender
+        if sender and self.draining:
+            sender.abort()
+
+    # see StreamSender.nudge(); safe to call from another thread
+    def nudge(self, ms):
+        sender = self.sender
+        if sender:
+            sender.nudge(ms)
+
+    # starts a Pico that play_song() is holding; safe to call from another thread
+    def start(self):
+        sender = self.sender
+        if sender:
+            sender.start()
+
+    # returns (scheduled, actual) ticks_us for each word recorded during the last
+    # song, oldest first; the raw REPL must still be active, as after play_song()
+    def fetch_jitter(self):
+        return _parse_jitter(self.pyboard.exec("m.dump_jitter()\r\n"))
+
+    # the player stays on the Pico for the next connection's session
+    def close(self):
+        self.pyboard.exit_raw_repl()
+        self.session_drives = 0
+
+    # lateness in microseconds of each (scheduled, actual) pair, allowing for ticks_us wrapping
+    @staticmethod
+    def lateness(samples):
+        return [((actual - scheduled + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+                for scheduled, actual in samples]
+
+    def _enter_raw_repl(self, soft_reset=True):
+        try:
+            self.pyboard.enter_raw_repl(soft_reset)
+        except PyboardError:
+            # the Pico may still have been finishing a stream from a host that went
+            # away, and swallowed our request; by now it will have given up on it
+            self.pyboard.enter_raw_repl(soft_reset)
+
+# the same as PicoConnection, over an AsyncPyboard; every method that talks to the
+# Pico is a coroutine. Create one with connect().
+class AsyncPicoConnection:
+    def __init__(self, board):
+        self.board = board
+        self.draining = False
+        self.sender = None
+        self.session_drives = 0
+        self.jitter_log = 0
+
+    @classmethod
+    async def connect(cls, device=None):
+        if device is None:
+            ports = PicoConnection.find_pico_ports()
+            if not ports:
+                raise RuntimeError("Pico not found")
+            device = ports[0]
+        return cls(await AsyncPyboard.connect(device))
+
+    # see PicoConnection.open_session()
+    async def open_session(self, drives=DEFAULT_DRIVES, fresh=False):
+        drives = max(drives, DEFAULT_DRIVES)
+        timings = []
+        start = time.monotonic()
+        await self._enter_raw_repl(soft_reset=fresh)
+        self.session_drives = int(await self.board.exec_(SESSION_PROBE))
+        self.jitter_log = 0
+        timings.append(('raw REPL', time.monotonic() - start))
+        if self.session_drives < drives:
+            start = time.monotonic()
+            await self.board.exec_("from music_player import MusicPlayer\r\n")
+            homing_ms = int(await self.board.exec_(f"m=MusicPlayer(drives={drives})\r\nprint(m.sound.homing_ms)\r\n"))
+            self.session_drives = drives
+            timings.append((f'new {drives}-drive player (homing {homing_ms} ms)', time.monotonic() - start))
+        _report_session(timings, self.session_drives)
+        return timings
+
+    # see PicoConnection.play_song(); ready, if given, is awaited
+    async def play_song(self, words, jitter_log=0, drives=DEFAULT_DRIVES, ready=None, on_sync=None):
+        sender = self.sender = AsyncStreamSender(self.board, on_sync=on_sync)
+        try:
+            if self.session_drives < drives:
+                await self.open_session(drives)
+            if jitter_log != self.jitter_log:
+                await self.board.exec_(f"m.instrument({jitter_log})\r\n")
+                self.jitter_log = jitter_log
+            await self.board.exec_raw_no_follow("m.play_stream()\r\n")
+            if ready:
+                await ready()
+            await sender.send(_with_fade(words))
+            self.draining = True
+            await sender.drain()
+            err = (await self.board.read_until(b'\x04', timeout=None))[:-1]
+            if err:
+                raise PyboardError('exception', b'', err)
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            sender.abort()
+            await self.board.follow(timeout=None)
+            raise
+        finally:
+            self.draining = False
+            self.sender = None
+            sender.report()
+
+    # see PicoConnection.abort(); to stop play_song() while it is still sending, cancel it
+    def abort(self):
+        sender = self.sender
+        if sender and self.draining:
+            sender.abort()
+
+    def nudge(self, ms):
+        sender = self.sender
+        if sender:
+            sender.nudge(ms)
+
+    async def fetch_jitter(self):
+        return _parse_jitter(await self.board.exec_("m.dump_jitter()\r\n"))
+
+    def close(self):
+        self.board.exit_raw_repl()
+        self.board.close()
+        self.session_drives = 0
+
+    async def _enter_raw_repl(self, soft_reset=True):
+        try:
+            await self.board.enter_raw_repl(soft_reset)
+        except PyboardError:
+            # see PicoConnection._enter_raw_repl()
+            await self.board.enter_raw_repl(soft_reset)
+
+# plays songs[i] (an iterable of words) on connections[i] (AsyncPicoConnections),
+# all from one event loop; every board starts once they are all ready to play.
+# drives gives the number of drives on each board.
+async def play_songs(connections, songs, drives):
+    # a countdown and an Event rather than asyncio.Barrier, which needs Python 3.11
+    waiting = [len(connections)]
+    all_ready = asyncio.Event()
+    async def ready():
+        waiting[0] -= 1
+        if not waiting[0]:
+            all_ready.set()
+        await all_ready.wait()
+    await asyncio.gather(*(connection.play_song(words, drives=n, ready=ready)
+                           for connection, words, n in zip(connections, songs, drives)))
+
+def _report_session(timings, drives):
+    steps = ', '.join('{} {:.2f} s'.format(step, seconds) for step, seconds in timings)
+    reused = '' if len(timings) > 1 else ', reusing the {}-drive player'.format(drives)
+    print('session: ready in {:.2f} s ({}{})'.format(sum(s for _, s in timings), steps, reused), file=sys.stderr)
+
+# finish with a one-second delay so notes can fade
+def _with_fade(words):
+    yield from words
+    yield 0x83e8
+
+# the (scheduled, actual) pairs in MusicPlayer.dump_jitter()'s output, oldest first
+def _parse_jitter(output):
+    lines = output.split()
+    if not lines:
+        return []
+    count, size = int(lines[0]), int(lines[1])
+    rings = []
+    for line in lines[2:4]:
+        ring = array('i')
+        ring.frombytes(bytes.fromhex(line.decode()))
+        if sys.byteorder == 'big':
+            ring.byteswap()
+        rings.append(ring)
+    n = min(count, size)
+    start = count % size if count > size else 0
+    order = [(start + i) % size for i in range(n)]
+    return [(rings[0][i], rings[1][i]) for i in order]
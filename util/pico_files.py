@@ -0,0 +1,257 @@
+# Copies files to and from the Pico much faster than pyboard.py's fs_put/fs_get,
+# which make a REPL round trip for every 256 bytes. A small receiver is loaded onto
+# the board once; each file then goes over as one command streaming raw bytes (or
+# base64, for links that aren't 8-bit clean) in large chunks, with the board handing
+# back a credit for each chunk it has written, the way raw-paste mode does. Both
+# ends hash what they sent and received, so a corrupted copy is never mistaken for
+# a good one, and sync() skips files whose hash on the board already matches.
+#   python3 util/pico_files.py put firmware/*.py
+#   python3 util/pico_files.py sync out/ /songs
+#   python3 util/pico_files.py get /songs/example.dat example.dat
+from argparse import ArgumentParser
+import base64
+import hashlib
+import os
+import sys
+import time
+from pico_connection import PicoConnection
+from pyboard import PyboardError
+
+CHUNK = 1024
+WINDOW = 8
+CREDIT = b'\x01'
+
+# the board side; f is left as None once a write fails, so that the rest of the file
+# can still be taken off the link before the error is reported
+RECEIVER = """
+import sys, os, hashlib, binascii, micropython
+def _hex(h):
+    return binascii.hexlify(h.digest()).decode()
+def _mkdirs(p):
+    parts = p.split('/')[:-1]
+    for i in range(1, len(parts) + 1):
+        d = '/'.join(parts[:i])
+        if d:
+            try:
+                os.mkdir(d)
+            except OSError:
+                pass
+def _put(p, n, c, w, b64):
+    _mkdirs(p)
+    f = open(p, 'wb')
+    h = hashlib.sha256()
+    buf = bytearray(c * 4 // 3 + 4 if b64 else c)
+    mv = memoryview(buf)
+    inp = sys.stdin.buffer
+    out = sys.stdout.buffer
+    err = None
+    micropython.kbd_intr(-1)
+    try:
+        out.write(b'\\x01' * w)
+        while n:
+            k = min(c, n)
+            m = (k + 2) // 3 * 4 if b64 else k
+            got = 0
+            while got < m:
+                got += inp.readinto(mv[got:m])
+            data = binascii.a2b_base64(mv[:m]) if b64 else mv[:m]
+            h.update(data)
+            if f:
+                try:
+                    f.write(data)
+                except OSError as e:
+                    err = e
+                    f.close()
+                    f = None
+            n -= k
+            out.write(b'\\x01')
+    finally:
+        micropython.kbd_intr(3)
+        if f:
+            f.close()
+    if err:
+        raise err
+    print(_hex(h))
+def _get(p, c, b64):
+    h = hashlib.sha256()
+    buf = bytearray(c)
+    mv = memoryview(buf)
+    out = sys.stdout.buffer
+    with open(p, 'rb') as f:
+        print(os.stat(p)[6])
+        while True:
+            k = f.readinto(buf)
+            if not k:
+                break
+            h.update(mv[:k])
+            out.write(binascii.b2a_base64(mv[:k])[:-1] if b64 else mv[:k])
+    print()
+    print(_hex(h))
+def _hashes(files):
+    buf = bytearray(1024)
+    mv = memoryview(buf)
+    for p, n in files:
+        try:
+            if os.stat(p)[6] != n:
+                raise OSError
+            h = hashlib.sha256()
+            with open(p, 'rb') as f:
+                while True:
+                    k = f.readinto(buf)
+                    if not k:
+                        break
+                    h.update(mv[:k])
+            print(_hex(h))
+        except OSError:
+            print('-')
+"""
+
+class FileTransfer:
+    # pyboard must be in the raw REPL; use_base64 sends data as base64 text
+    def __init__(self, pyboard, use_base64=False, verbose=True):
+        self.pyboard = pyboard
+        self.use_base64 = use_base64
+        self.verbose = verbose
+        self.copied = []        # the path on the board of each file put there
+        self.pyboard.exec_(RECEIVER)
+
+    # copies the local file src to dest on the board
+    def put(self, src, dest):
+        with open(src, 'rb') as f:
+            data = f.read()
+        start = time.monotonic()
+        serial = self.pyboard.serial
+        self.pyboard.exec_raw_no_follow(f"_put({dest!r},{len(data)},{CHUNK},{WINDOW},{int(self.use_base64)})")
+        credits = 0
+        for i in range(0, len(data), CHUNK):
+            while credits == 0:
+                credits += self._take_credit()
+            chunk = data[i:i + CHUNK]
+            serial.write(base64.b64encode(chunk) if self.use_base64 else chunk)
+            credits -= 1
+        out, err = self.pyboard.follow(timeout=None)
+        if err:
+            raise PyboardError('exception', out, err)
+        self._check(dest, hashlib.sha256(data).hexdigest(), out.lstrip(CREDIT))
+        self.copied.append(dest)
+        self._report('put', dest, len(data), start)
+
+    # copies src on the board to the local file dest
+    def get(self, src, dest):
+        start = time.monotonic()
+        # in base64, every chunk but the last must be a whole number of 3-byte groups,
+        # so that the encoded chunks join up into one unpadded string
+        chunk = CHUNK // 3 * 3 if self.use_base64 else CHUNK
+        self.pyboard.exec_raw_no_follow(f"_get({src!r},{chunk},{int(self.use_base64)})")
+        line = self.pyboard.read_until(1, b'\n', timeout=None)
+        if line.startswith(b'\x04'):
+            # the board couldn't open the file, and has gone straight to the end of its output
+            err = line[1:] + self.pyboard.read_until(1, b'\x04', timeout=None)
+            raise PyboardError('exception', b'', err[:-1])
+        size = int(line)
+        if self.use_base64:
+            data = base64.b64decode(self.pyboard.read_until(1, b'\r\n', timeout=None)[:-2])
+        else:
+            data = self.pyboard.serial.read(size)
+            self.pyboard.read_until(1, b'\r\n')
+        out, err = self.pyboard.follow(timeout=None)
+        if err:
+            raise PyboardError('exception', out, err)
+        if len(data) != size:
+            raise PyboardError(f'{src}: expected {size} bytes, received {len(data)}')
+        self._check(src, hashlib.sha256(data).hexdigest(), out)
+        with open(dest, 'wb') as f:
+            f.write(data)
+        self._report('got', src, size, start)
+
+    # the sha256 of each of the given files on the board whose size is the one
+    # given with it, in order; None for the rest (including any that don't exist)
+    def hashes(self, files):
+        out = self.pyboard.exec_(f"_hashes({list(files)!r})")
+        return [None if line == '-' else line for line in out.decode().split()]
+
+    # copies every file under local_dir to the same place under remote_dir, unless
+    # the board already has an identical copy; returns the number of files copied
+    def sync(self, local_dir, remote_dir='/'):
+        files = []
+        for root, dirs, names in os.walk(local_dir):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, local_dir).replace(os.sep, '/')
+                files.append((path, remote_dir.rstrip('/') + '/' + relative))
+        remote_hashes = self.hashes((dest, os.path.getsize(path)) for path, dest in files)
+        copied = 0
+        for (path, dest), remote_hash in zip(files, remote_hashes):
+            with open(path, 'rb') as f:
+                local_hash = hashlib.sha256(f.read()).hexdigest()
+            if local_hash == remote_hash:
+                continue
+            self.put(path, dest)
+            copied += 1
+        if self.verbose:
+            print(f'{copied} file(s) copied, {len(files) - copied} already up to date', file=sys.stderr)
+        return copied
+
+    def _take_credit(self):
+        data = self.pyboard.serial.read(1)
+        if data == CREDIT:
+            return 1
+        # the receiver has failed, and this is the end of its (empty) output
+        err = self.pyboard.read_until(1, b'\x04', timeout=None)[:-1]
+        raise PyboardError('exception', data, err)
+
+    def _check(self, name, expected, received):
+        received = received.strip().decode()
+        if received != expected:
+            raise PyboardError(f'{name}: checksum mismatch (sent {expected}, board has {received})')
+
+    def _report(self, verb, name, size, start):
+        if self.verbose:
+            elapsed = time.monotonic() - start
+            print(f'{verb} {name}: {size} bytes in {elapsed:.2f} s ({size / max(elapsed, 1e-6) / 1024:.1f} KiB/s)', file=sys.stderr)
+
+def main():
+    parser = ArgumentParser(description="Copy files to and from the Pico's file system")
+    parser.add_argument('--device', type=str, default=None,
+                        help='serial port of the Pico (default: the first one found)')
+    parser.add_argument('--base64', action='store_true',
+                        help='send data as base64 text, for connections that are not 8-bit clean')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    put = subparsers.add_parser('put', help='copy files to the board')
+    put.add_argument('files', nargs='+', metavar='FILE')
+    put.add_argument('--dest', default='/', help='directory on the board to copy them into (default: /)')
+    get = subparsers.add_parser('get', help='copy a file from the board')
+    get.add_argument('src', help='file on the board')
+    get.add_argument('dest', nargs='?', help='where to save it (default: its name, in the current directory)')
+    sync = subparsers.add_parser('sync', help='copy a directory to the board, skipping files it already has')
+    sync.add_argument('local_dir')
+    sync.add_argument('remote_dir', nargs='?', default='/')
+    args = parser.parse_args()
+
+    pico = PicoConnection(args.device)
+    try:
+        # a player left on the Pico between songs (see PicoConnection.open_session())
+        # is kept, unless new firmware is copied and the Pico has to load it
+        pico.pyboard.enter_raw_repl(soft_reset=False)
+        transfer = FileTransfer(pico.pyboard, args.base64)
+        if args.command == 'put':
+            for path in args.files:
+                transfer.put(path, args.dest.rstrip('/') + '/' + os.path.basename(path))
+        elif args.command == 'get':
+            transfer.get(args.src, args.dest or os.path.basename(args.src))
+        else:
+            transfer.sync(args.local_dir, args.remote_dir)
+        if any(path.endswith('.py') for path in transfer.copied):
+            pico.pyboard.enter_raw_repl()
+    except PyboardError as e:
+        if len(e.args) == 3:
+            sys.exit(e.args[2].decode(errors='replace'))
+        sys.exit(str(e))
+    except OSError as e:
+        sys.exit(str(e))
+    finally:
+        pico.close()
+
+if __name__ == '__main__':
+    main()
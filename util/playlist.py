@@ -0,0 +1,48 @@
+# Plays songs already on the Pico's file system (copied there with util/pico_files.py)
+# back to back, with no gap between them: the Pico reads the start of each song while
+# the last one is still playing. While they play, type the path of another song on
+# the board to queue it, "skip" to move on to the next song or "stop" to stop.
+#   python3 util/playlist.py /songs/one.dat /songs/two.dat
+from argparse import ArgumentParser
+import sys
+import threading
+from pico_connection import DEFAULT_DRIVES, PicoConnection
+from pyboard import PyboardError
+
+# reads commands typed while the playlist plays, until the input runs out
+def read_commands(pico):
+    for line in sys.stdin:
+        line = line.strip()
+        if line == 'skip':
+            pico.skip_song()
+        elif line == 'stop':
+            pico.stop_playlist()
+        elif line:
+            pico.queue_song(line)
+
+def main():
+    parser = ArgumentParser(description="Play songs from the Pico's file system without a gap between them")
+    parser.add_argument('paths', nargs='+', metavar='PATH', help='song on the board, as converted by convert_midi.py')
+    parser.add_argument('--device', type=str, default=None,
+                        help='serial port of the Pico (default: the first one found)')
+    parser.add_argument('--drives', type=int, default=DEFAULT_DRIVES,
+                        help=f'number of drives the songs were converted for (default: {DEFAULT_DRIVES})')
+    parser.add_argument('--fresh', action='store_true',
+                        help='soft-reset the Pico and start a new player first')
+    args = parser.parse_args()
+
+    pico = PicoConnection(args.device)
+    try:
+        pico.open_session(args.drives, args.fresh)
+        threading.Thread(target=read_commands, args=(pico,), daemon=True).start()
+        pico.play_playlist(args.paths, args.drives,
+                           on_song=lambda path: print(f'playing {path}', file=sys.stderr))
+    except PyboardError as e:
+        if len(e.args) == 3:
+            sys.exit(e.args[2].decode(errors='replace'))
+        sys.exit(str(e))
+    finally:
+        pico.close()
+
+if __name__ == '__main__':
+    main()
@@ -71,6 +71,15 @@ import sys
 import time
 import os
 import ast
+import array
+
+try:
+    import fcntl
+    import select
+    import termios
+except ImportError:
+    # without these (on Windows), connections are polled
+    fcntl = select = termios = None
 
 try:
     stdout = sys.stdout.buffer
@@ -198,7 +207,18 @@ class ProcessToSerial:
         self.subp.stdin.write(data)
         return len(data)
 
+    def fileno(self):
+        return self.subp.stdout.fileno()
+
     def inWaiting(self):
+        # ask the pipe how much it holds, so it can all be read at once
+        if fcntl:
+            n = array.array("i", [0])
+            try:
+                fcntl.ioctl(self.fileno(), termios.FIONREAD, n)
+                return n[0]
+            except OSError:
+                pass
         # res = self.sel.select(0)
         res = self.poll.poll(0)
         if res:
@@ -247,10 +267,66 @@ class ProcessPtyToTerminal:
     def write(self, data):
         return self.ser.write(data)
 
+    def fileno(self):
+        return self.ser.fileno()
+
     def inWaiting(self):
         return self.ser.inWaiting()
 
 
+class BufferedSerial:
+    """Wrap one of the connections above so that a read can take everything
+    that is waiting in one go.  Whatever it takes beyond what was wanted is
+    handed back with unread() and served first by the next read."""
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.pending = bytearray()
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+    def close(self):
+        self.serial.close()
+
+    def read(self, size=1):
+        if len(self.pending) < size:
+            self.pending += self.serial.read(size - len(self.pending))
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    # everything that has been received, without waiting for more
+    def read_waiting(self):
+        n = self.serial.inWaiting()
+        if n:
+            self.pending += self.serial.read(n)
+        data = bytes(self.pending)
+        self.pending.clear()
+        return data
+
+    def unread(self, data):
+        self.pending[:0] = data
+
+    def write(self, data):
+        return self.serial.write(data)
+
+    def inWaiting(self):
+        return len(self.pending) + self.serial.inWaiting()
+
+    # block until there may be something to read, or timeout seconds (None for
+    # ever) have passed; connections without a file descriptor are polled
+    def wait_readable(self, timeout):
+        try:
+            fd = self.serial.fileno()
+        except (AttributeError, OSError, ValueError):
+            fd = None
+        if fd is None or select is None:
+            time.sleep(0.01 if timeout is None else min(timeout, 0.01))
+        else:
+            select.select([fd], [], [], timeout)
+
+
 class Pyboard:
     def __init__(
         self, device, baudrate=115200, user="micro", password="python", wait=0, exclusive=True
@@ -291,6 +367,7 @@ class Pyboard:
                 raise PyboardError("failed to access " + device)
             if delayed:
                 print("")
+        self.serial = BufferedSerial(self.serial)
 
     def close(self):
         self.serial.close()
@@ -299,29 +376,38 @@ class Pyboard:
         # if data_consumer is used then data is not accumulated and the ending must be 1 byte long
         assert data_consumer is None or len(ending) == 1
 
-        data = self.serial.read(min_num_bytes)
-        if data_consumer:
-            data_consumer(data)
-        timeout_count = 0
+        # Read everything that is waiting at once, and only search what is new for
+        # the ending; anything received after the ending is kept for the next read.
+        # timeout is how long to wait for more data since the last arrived.
+        data = bytearray(self.serial.read(min_num_bytes))
+        start = 0
+        last_data = time.monotonic()
         while True:
-            if data.endswith(ending):
+            end = data.find(ending, start)
+            if end >= 0:
+                end += len(ending)
+                self.serial.unread(data[end:])
+                del data[end:]
                 break
-            elif self.serial.inWaiting() > 0:
-                new_data = self.serial.read(1)
-                if data_consumer:
-                    data_consumer(new_data)
-                    data = new_data
-                else:
-                    data = data + new_data
-                timeout_count = 0
+            if data_consumer:
+                if data:
+                    data_consumer(bytes(data))
+                data.clear()
+            start = max(0, len(data) - len(ending) + 1)
+            new_data = self.serial.read_waiting()
+            if new_data:
+                data += new_data
+                last_data = time.monotonic()
             else:
-                timeout_count += 1
-                if timeout is not None and timeout_count >= 100 * timeout:
+                remaining = None if timeout is None else last_data + timeout - time.monotonic()
+                if remaining is not None and remaining <= 0:
                     break
-                time.sleep(0.01)
-        return data
+                self.serial.wait_readable(remaining)
+        if data_consumer and data:
+            data_consumer(bytes(data))
+        return bytes(data)
 
-    def enter_raw_repl(self):
+    def enter_raw_repl(self, soft_reset=True):
         self.serial.write(b"\r\x03\x03")  # ctrl-C twice: interrupt any running program
 
         # flush input (without relying on serial.flushInput())
@@ -331,16 +417,19 @@ class Pyboard:
             n = self.serial.inWaiting()
 
         self.serial.write(b"\r\x01")  # ctrl-A: enter raw REPL
-        data = self.read_until(1, b"raw REPL; CTRL-B to exit\r\n>")
-        if not data.endswith(b"raw REPL; CTRL-B to exit\r\n>"):
-            print(data)
-            raise PyboardError("could not enter raw repl")
 
-        self.serial.write(b"\x04")  # ctrl-D: soft reset
-        data = self.read_until(1, b"soft reboot\r\n")
-        if not data.endswith(b"soft reboot\r\n"):
-            print(data)
-            raise PyboardError("could not enter raw repl")
+        if soft_reset:
+            data = self.read_until(1, b"raw REPL; CTRL-B to exit\r\n>")
+            if not data.endswith(b"raw REPL; CTRL-B to exit\r\n>"):
+                print(data)
+                raise PyboardError("could not enter raw repl")
+
+            self.serial.write(b"\x04")  # ctrl-D: soft reset
+            data = self.read_until(1, b"soft reboot\r\n")
+            if not data.endswith(b"soft reboot\r\n"):
+                print(data)
+                raise PyboardError("could not enter raw repl")
+
         # By splitting this into 2 reads, it allows boot.py to print stuff,
         # which will show up after the soft reboot and before the raw REPL.
         data = self.read_until(1, b"raw REPL; CTRL-B to exit\r\n")
@@ -0,0 +1,198 @@
+# Plays a song file written by convert_midi.py through the firmware itself, on the
+# MicroPython stand-ins in util/stubs and a virtual clock, and records when each drive
+# starts and stops and how fast it steps. Nothing here decodes words: the firmware's
+# own play_song() and Sound do that, so what is checked is what a Pico would play,
+# only far faster than real time and without any drives. The notes can be saved as
+# CSV (to compare conversions), summarized (to see what the encoder's merged notes-off
+# and retrigger gaps come to) and rendered to a WAV file, which needs NumPy.
+#   python3 util/simulate.py song.dat --wav song.wav
+#   python3 util/simulate.py song.dat --drives 8 --notes song.csv
+from argparse import ArgumentParser
+import csv
+import os
+import sys
+import time
+import wave
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE_DIR = os.path.join(os.path.dirname(UTIL_DIR), 'firmware')
+sys.path[:0] = [os.path.join(UTIL_DIR, 'stubs'), FIRMWARE_DIR]
+
+import machine
+import rp2
+import utime
+import sound
+from music_player import MusicPlayer
+
+SAMPLE_RATE = 44100
+# the drive programs in firmware/sound.py take this many PIO cycles a step
+PIO_CYCLES_PER_STEP = 30
+# the encoder runs notes together when one stops less than this long before the next
+# event, and stops a repeated note this long before playing it again
+MERGE_US = 10000
+RETRIGGER_US = 30000
+
+# each step of a drive's head, as heard: a short burst of a resonance that dies away
+CLICK_MS = 4
+CLICK_HZ = 1800
+
+# one note on one drive, in microseconds from the start of the song; hz is the rate
+# the drive steps at, worked out from the clock divider the firmware chose for it
+class Note:
+    __slots__ = ('drive', 'start_us', 'end_us', 'hz')
+
+    def __init__(self, drive, start_us, end_us, hz):
+        self.drive = drive
+        self.start_us = start_us
+        self.end_us = end_us
+        self.hz = hz
+
+# follows the drives' state machines as the firmware starts and stops them
+class Recorder:
+    def __init__(self, drives):
+        self.drives = drives
+        self.start_us = utime.clock.now_us()
+        self.playing = [None] * drives  # (start_us, hz) of the note on each drive
+        self.notes = []
+
+    def on_active(self, sm, value):
+        if sm.id >= self.drives:
+            return
+        now = utime.clock.now_us() - self.start_us
+        hz = None
+        if value:
+            div = machine.mem32[sound._SM_CLKDIV[sm.id]] >> 8
+            hz = machine.freq() * 256 / div / PIO_CYCLES_PER_STEP if div else None
+        playing = self.playing[sm.id]
+        if playing and playing[1] == hz:
+            # the same note played again without stopping is heard as one
+            return
+        if playing:
+            self.notes.append(Note(sm.id, playing[0], now, playing[1]))
+        self.playing[sm.id] = (now, hz) if hz else None
+
+# plays filename through a player with the given number of drives, and returns
+# (notes in order of starting, length of the song in microseconds)
+def simulate(filename, drives=4):
+    if drives > sound._SMS_PER_PIO * len(sound._PIO_BASES):
+        raise ValueError(f'a board can play at most {sound._SMS_PER_PIO * len(sound._PIO_BASES)} drives')
+    if drives > sound._SMS_PER_PIO * rp2.PIO_BLOCKS:
+        rp2.PIO_BLOCKS = len(sound._PIO_BASES)
+    utime.clock = utime.VirtualClock()
+    utime.timers.clear()
+    utime.timer_log.clear()
+    player = MusicPlayer(drives=drives)
+    recorder = Recorder(drives)
+    rp2.on_active = recorder.on_active
+    try:
+        player.play_song(filename)
+    finally:
+        rp2.on_active = None
+    notes = sorted(recorder.notes, key=lambda note: (note.start_us, note.drive))
+    return notes, max((note.end_us for note in notes), default=0)
+
+# per drive: notes played, and the silences between consecutive notes
+def summarize(notes, drives, length_us):
+    by_drive = [[] for _ in range(drives)]
+    for note in notes:
+        by_drive[note.drive].append(note)
+    for drive, played in enumerate(by_drive):
+        sounding = sum(note.end_us - note.start_us for note in played)
+        legato = merged = retriggered = 0
+        gaps = []
+        for before, after in zip(played, played[1:]):
+            gap = after.start_us - before.end_us
+            if gap <= 0:
+                legato += 1
+            else:
+                gaps.append(gap)
+                if gap < MERGE_US:
+                    merged += 1
+                if after.hz == before.hz and abs(gap - RETRIGGER_US) < 1000:
+                    retriggered += 1
+        print('drive {}: {} notes, sounding {:.0%} of the time; {} run straight into the next, '
+              '{} gaps (shortest {}), {} under {} ms, {} retriggered'.format(
+                  drive, len(played), sounding / max(length_us, 1), legato, len(gaps),
+                  '{:.1f} ms'.format(min(gaps) / 1000) if gaps else '-',
+                  merged, MERGE_US // 1000, retriggered), file=sys.stderr)
+
+def save_notes(path, notes):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['drive', 'start_ms', 'end_ms', 'hz'])
+        for note in notes:
+            writer.writerow([note.drive, '{:.3f}'.format(note.start_us / 1000),
+                             '{:.3f}'.format(note.end_us / 1000), '{:.2f}'.format(note.hz)])
+
+# the notes mixed down to 16-bit samples: each drive a train of clicks, one per step
+# of its head, or with style='square', a square wave at its stepping rate
+def render(notes, length_us, drives, style='click', rate=SAMPLE_RATE):
+    if np is None:
+        raise RuntimeError('rendering needs NumPy (pip install numpy)')
+    total = length_us * rate // 1000000 + 1
+    mix = np.zeros(total)
+    for note in notes:
+        first = note.start_us * rate // 1000000
+        last = note.end_us * rate // 1000000
+        if last <= first:
+            continue
+        if style == 'square':
+            t = np.arange(first, last) / rate - note.start_us / 1000000
+            mix[first:last] += np.where((t * note.hz) % 1 < 0.5, 1.0, -1.0)
+        else:
+            steps = np.arange(0, (note.end_us - note.start_us) * note.hz / 1000000) / note.hz
+            np.add.at(mix, first + (steps * rate).astype(np.int64), 1.0)
+    if style != 'square':
+        t = np.arange(rate * CLICK_MS // 1000) / rate
+        click = np.exp(-t * 4000 / CLICK_MS) * np.sin(2 * np.pi * CLICK_HZ * t)
+        mix = np.convolve(mix, click)[:total]
+    peak = np.abs(mix).max()
+    if peak:
+        mix *= 0.8 / max(peak, drives / 2)
+    return (mix * 32767).astype('<i2')
+
+def save_wav(path, samples, rate=SAMPLE_RATE):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(samples.tobytes())
+
+def main():
+    parser = ArgumentParser(description='Simulate playing a converted song, without a Pico')
+    parser.add_argument('file', help='song file written by convert_midi.py')
+    parser.add_argument('--drives', type=int, default=4,
+                        help='number of drives the song was converted for (default: 4)')
+    parser.add_argument('--notes', metavar='CSV', help='save every note played to a CSV file')
+    parser.add_argument('--wav', metavar='FILE', help='render the song to a WAV file (needs NumPy)')
+    parser.add_argument('--sound', choices=('click', 'square'), default='click',
+                        help='render each drive as the clicks of its head stepping (default) or as a square wave')
+    parser.add_argument('--rate', type=int, default=SAMPLE_RATE, help=f'WAV sample rate (default: {SAMPLE_RATE})')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        notes, length_us = simulate(args.file, args.drives)
+    except (OSError, ValueError) as e:
+        sys.exit(str(e))
+    elapsed = time.perf_counter() - start
+    print('simulate: {:.1f} s of song in {:.2f} s ({:.0f}x real time), {} notes'.format(
+        length_us / 1000000, elapsed, length_us / 1000000 / max(elapsed, 1e-6), len(notes)), file=sys.stderr)
+    summarize(notes, args.drives, length_us)
+    if args.notes:
+        save_notes(args.notes, notes)
+    if args.wav:
+        try:
+            samples = render(notes, length_us, args.drives, args.sound, args.rate)
+        except RuntimeError as e:
+            sys.exit(str(e))
+        save_wav(args.wav, samples, args.rate)
+        print(f'simulate: wrote {len(samples) / args.rate:.1f} s to {args.wav}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
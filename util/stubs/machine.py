@@ -0,0 +1,72 @@
+# MicroPython-compatible stand-in for machine, for running the firmware on the host
+import utime
+
+_freq = 125000000
+
+def freq(hz=None):
+    global _freq
+    if hz is None:
+        return _freq
+    _freq = hz
+
+# register writes are recorded rather than performed
+class _Mem(dict):
+    def __getitem__(self, addr):
+        return self.get(addr, 0)
+
+mem32 = _Mem()
+
+class Pin:
+    IN = 0
+    OUT = 1
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self._value = 0 if value is None else value
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = v
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+# callbacks are run by utime.run_due_timers() when the firmware sleeps or idles
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, **kwargs):
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, freq=-1, period=-1, callback=None):
+        self.deinit()
+        self._mode = mode
+        self._period_us = 1000000 // freq if freq > 0 else period * 1000
+        self._callback = callback
+        self._due_us = utime.clock.now_us() + self._period_us
+        utime.timers.append(self)
+
+    def deinit(self):
+        if self in utime.timers:
+            utime.timers.remove(self)
+
+    def _expire(self):
+        if self._mode == Timer.PERIODIC:
+            self._due_us += self._period_us
+        else:
+            self.deinit()
+
+# wait for the next "interrupt": a timer coming due, or the 1 ms tick
+def idle():
+    due = utime.next_due_us()
+    wait = 1000 if due is None else min(1000, max(0, due - utime.clock.now_us()))
+    if due is None and isinstance(utime.clock, utime.VirtualClock):
+        # nothing scheduled, so we must be waiting on the outside world
+        utime.RealClock().sleep_us(wait)
+    utime.wait_us(wait)
@@ -0,0 +1,12 @@
+# MicroPython-compatible stand-in for micropython, for running the firmware on the host
+def const(value):
+    return value
+
+def kbd_intr(chr):
+    pass
+
+def native(f):
+    return f
+
+def viper(f):
+    return f
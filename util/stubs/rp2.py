@@ -0,0 +1,62 @@
+# MicroPython-compatible stand-in for rp2, for running the firmware on the host
+
+# 2 like an RP2040, or 3 like an RP2350
+PIO_BLOCKS = 2
+
+# if set, called with (state machine, value) whenever a state machine is started
+# or stopped, e.g. by util/simulate.py to follow which notes are playing
+on_active = None
+
+class PIO:
+    IN_LOW = 0
+    IN_HIGH = 1
+    OUT_LOW = 2
+    OUT_HIGH = 3
+    SHIFT_LEFT = 0
+    SHIFT_RIGHT = 1
+
+    def __init__(self, id):
+        if id < 0 or id >= PIO_BLOCKS:
+            raise ValueError('invalid PIO')
+        self.id = id
+
+    def add_program(self, program):
+        pass
+
+    def remove_program(self, program=None):
+        pass
+
+# PIO programs are never assembled; the decorated function is kept as the program
+def asm_pio(**kwargs):
+    return lambda program: program
+
+class StateMachine:
+    def __init__(self, id, program=None, freq=-1, **kwargs):
+        self.id = id
+        self.program = program
+        self.freq = freq
+        self.fifo = []
+        self._active = 0
+
+    def init(self, program, freq=-1, **kwargs):
+        self.program = program
+        self.freq = freq
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = value
+        if on_active:
+            on_active(self, value)
+
+    def put(self, value, shift=0):
+        self.fifo.append(value >> shift)
+
+    def get(self, buf=None, shift=0):
+        return 0
+
+    def rx_fifo(self):
+        return 0
+
+    def tx_fifo(self):
+        return len(self.fifo)
@@ -0,0 +1,99 @@
+# MicroPython-compatible stand-in for utime, for running the firmware on the host.
+# Time comes from `clock`, which can be swapped for a VirtualClock; machine.Timer
+# callbacks run whenever the firmware sleeps or idles, much as soft IRQs do.
+import time
+
+TICKS_PERIOD = 1 << 30
+_TICKS_MAX = TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+# rate is how fast this clock runs compared with the host's, for playing
+# the part of a board whose crystal is a little off
+class RealClock:
+    def __init__(self, rate=1.0):
+        self.rate = rate
+
+    def now_us(self):
+        return int(time.monotonic_ns() * self.rate) // 1000
+
+    def sleep_us(self, us):
+        if us > 0:
+            time.sleep(us / 1000000 / self.rate)
+
+# time only moves when the firmware sleeps or idles (and by a microsecond each
+# time the clock is read, so busy-waits still finish), so runs are fast and repeatable
+class VirtualClock:
+    def __init__(self):
+        self.us = 0
+
+    def now_us(self):
+        self.us += 1
+        return self.us
+
+    def sleep_us(self, us):
+        if us > 0:
+            self.us += us
+
+clock = RealClock()
+
+# armed machine.Timer objects, and (timer, due, fired) in microseconds for each callback run
+timers = []
+timer_log = []
+_in_callback = False
+
+def run_due_timers():
+    global _in_callback
+    # like soft IRQs, callbacks never interrupt another callback
+    if _in_callback:
+        return
+    _in_callback = True
+    try:
+        while True:
+            now = clock.now_us()
+            due = [t for t in timers if t._due_us <= now]
+            if not due:
+                break
+            t = min(due, key=lambda t: t._due_us)
+            timer_log.append((t, t._due_us, now))
+            t._expire()
+            t._callback(t)
+    finally:
+        _in_callback = False
+
+def next_due_us():
+    return min((t._due_us for t in timers), default=None)
+
+def wait_us(us):
+    end = clock.now_us() + us
+    while True:
+        due = next_due_us()
+        if due is None or due > end:
+            clock.sleep_us(end - clock.now_us())
+            run_due_timers()
+            return
+        clock.sleep_us(due - clock.now_us())
+        run_due_timers()
+
+def ticks_ms():
+    return (clock.now_us() // 1000) & _TICKS_MAX
+
+def ticks_us():
+    return clock.now_us() & _TICKS_MAX
+
+def ticks_cpu():
+    return ticks_us()
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + _TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
+
+def sleep_ms(ms):
+    wait_us(ms * 1000)
+
+def sleep_us(us):
+    wait_us(us)
+
+def sleep(s):
+    wait_us(int(s * 1000000))